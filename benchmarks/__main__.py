@@ -0,0 +1,65 @@
+# Runs the workloads against both engines and prints a scaling curve per workload
+#   python -m benchmarks [--workload NAME] [--engine python|sqlite] [--sizes 10,20] [--cycles N] [--json]
+import argparse
+import json
+import time
+import tracemalloc
+
+import pymicrolog.microlog
+import pymicrolog.sqlite.microlog
+
+from .workloads import WORKLOADS
+
+ENGINES = {
+    "python": pymicrolog.microlog,
+    "sqlite": pymicrolog.sqlite.microlog,
+}
+
+
+def measure(engine, builder, size, cycles):
+    # timing and memory are taken in separate runs, tracing allocations slows the engines down;
+    # peak memory only counts Python allocations, not those made inside sqlite
+    rules = builder(engine, size)
+    start = time.perf_counter()
+    program = engine.Program(rules)
+    built = time.perf_counter()
+    program.run(cycles)
+    elapsed = time.perf_counter() - built
+    tracemalloc.start()
+    engine.Program(builder(engine, size)).run(min(cycles, 3))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "build_seconds": built - start,
+        "cycles_per_second": cycles / elapsed if elapsed else float("inf"),
+        "peak_kib": peak // 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS))
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES))
+    parser.add_argument("--sizes", help="comma separated sizes instead of each workload's defaults")
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print one JSON object per measurement")
+    args = parser.parse_args()
+    for name in args.workload or sorted(WORKLOADS):
+        builder, sizes = WORKLOADS[name]
+        if args.sizes:
+            sizes = [int(size) for size in args.sizes.split(",")]
+        if not args.json:
+            print(name)
+            print("  {:<8}{:>8}{:>12}{:>12}{:>12}".format("engine", "size", "build s", "cycles/s", "peak KiB"))
+        for engine_name in args.engine or sorted(ENGINES):
+            for size in sizes:
+                result = measure(ENGINES[engine_name], builder, size, args.cycles)
+                if args.json:
+                    print(json.dumps({"workload": name, "engine": engine_name, "size": size, "cycles": args.cycles, **result}))
+                else:
+                    print("  {:<8}{:>8}{:>12.3f}{:>12.1f}{:>12}".format(
+                        engine_name, size, result["build_seconds"], result["cycles_per_second"], result["peak_kib"]))
+
+
+if __name__ == "__main__":
+    main()
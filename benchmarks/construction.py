@@ -0,0 +1,39 @@
+# Program construction time for generated programs with many relations
+#   python -m benchmarks.construction [relations ...]
+import random
+import sys
+import time
+
+import pymicrolog.microlog
+import pymicrolog.sqlite.microlog
+
+
+def layered_program(engine, relations, seed=0):
+    # relations in layers of 100, every relation reads two relations of its own or the layer below,
+    # every fifth one negates a relation of the layer below
+    rnd = random.Random(seed)
+    rels = [engine.relation("r{}".format(n)) for n in range(relations)]
+    X = engine.variable("X")
+    rules = [rels[n](n) for n in range(min(100, relations))]
+    for n in range(100, relations):
+        below = rnd.randrange(n - n % 100 - 100, n - n % 100)
+        same = rnd.randrange(n - n % 100, n + 1)
+        body = rels[below](X) & rels[same](X)
+        if n % 5 == 0:
+            body = body & ~rels[rnd.randrange(n - n % 100 - 100, n - n % 100)](X)
+        rules.append(rels[n](X) <= body)
+    return rules
+
+
+def main(sizes):
+    for name, engine in [("python", pymicrolog.microlog), ("sqlite", pymicrolog.sqlite.microlog)]:
+        for relations in sizes:
+            rules = layered_program(engine, relations)
+            start = time.perf_counter()
+            program = engine.Program(rules)
+            elapsed = time.perf_counter() - start
+            print("{:<8}{:>8} relations {:>5} strata {:>9.3f}s".format(name, relations, len(program.strata), elapsed))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 20000])
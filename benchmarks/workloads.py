@@ -0,0 +1,73 @@
+# Parametric programs for the benchmarks, every workload takes an engine module and a size and
+# returns the rules of a program whose cycles all do the same amount of work
+import random
+
+
+def transitive_closure(engine, nodes, seed=0):
+    # a random graph with two edges per node, carried from cycle to cycle so its closure is
+    # derived again in every cycle
+    rnd = random.Random(seed)
+    edge, path, cyclic = engine.relation("edge"), engine.relation("path"), engine.relation("cyclic")
+    X, Y, Z = engine.variables("X", "Y", "Z")
+    rules = [edge(rnd.randrange(nodes), rnd.randrange(nodes)) @ engine.START for _ in range(2 * nodes)]
+    rules += [
+        edge(X, Y) @ engine.NEXT <= edge(X, Y),
+        path(X, Y) <= edge(X, Y),
+        path(X, Z) <= path(X, Y) & edge(Y, Z),
+        cyclic(X) @ engine.NEXT <= path(X, X),
+    ]
+    return rules
+
+
+def negation_chain(engine, length, width=50):
+    # length strata, every level holds the items the level below does not
+    item, even = engine.relation("item"), engine.relation("even")
+    levels = [engine.relation("level{}".format(n)) for n in range(length)]
+    X = engine.variable("X")
+    rules = [item(n) @ engine.START for n in range(width)]
+    rules += [even(n) for n in range(0, width, 2)]
+    rules += [item(X) @ engine.NEXT <= item(X), levels[0](X) <= item(X) & even(X)]
+    rules += [levels[n + 1](X) <= item(X) & ~levels[n](X) for n in range(length - 1)]
+    return rules
+
+
+def wide_join(engine, side, seed=0):
+    # the connect4 winner rules on a randomly filled side x side board
+    rnd = random.Random(seed)
+    marker, player, winner = engine.relation("marker"), engine.relation("player"), engine.relation("winner")
+    top_of, besides, won = engine.relation("top_of"), engine.relation("besides"), engine.relation("won")
+    C, R, P = engine.variables("C", "R", "P")
+    C1, C2, C3, C4 = engine.variables("C1", "C2", "C3", "C4")
+    R1, R2, R3, R4 = engine.variables("R1", "R2", "R3", "R4")
+    rules = [player(1), player(2)]
+    rules += [top_of(n + 1, n) for n in range(side - 1)]
+    rules += [besides(n + 1, n) for n in range(side - 1)]
+    rules += [marker(c, r, rnd.choice((0, 1, 2))) @ engine.START for c in range(side) for r in range(side)]
+    rules += [
+        marker(C, R, P) @ engine.NEXT <= marker(C, R, P),
+        winner(P) <= player(P) & marker(C1, R, P) & besides(C1, C2) & besides(C2, C3) & besides(C3, C4) & marker(C2, R, P) & marker(C3, R, P) & marker(C4, R, P),
+        winner(P) <= player(P) & marker(C, R1, P) & top_of(R1, R2) & top_of(R2, R3) & top_of(R3, R4) & marker(C, R2, P) & marker(C, R3, P) & marker(C, R4, P),
+        winner(P) <= player(P) & marker(C1, R1, P) & top_of(R1, R2) & top_of(R2, R3) & top_of(R3, R4) & besides(C1, C2) & besides(C2, C3) & besides(C3, C4) & marker(C2, R2, P) & marker(C3, R3, P) & marker(C4, R4, P),
+        winner(P) <= player(P) & marker(C1, R1, P) & top_of(R1, R2) & top_of(R2, R3) & top_of(R3, R4) & besides(C2, C1) & besides(C3, C2) & besides(C4, C3) & marker(C2, R2, P) & marker(C3, R3, P) & marker(C4, R4, P),
+        won(P) @ engine.NEXT <= winner(P),
+    ]
+    return rules
+
+
+def temporal_loop(engine, counters, modulo=10):
+    # counters that each step through 0..modulo-1, one @NEXT fact per counter and cycle
+    count, succ = engine.relation("count"), engine.relation("succ")
+    I, V, W = engine.variables("I", "V", "W")
+    rules = [count(n, n % modulo) @ engine.START for n in range(counters)]
+    rules += [succ(n, (n + 1) % modulo) for n in range(modulo)]
+    rules += [count(I, W) @ engine.NEXT <= count(I, V) & succ(V, W)]
+    return rules
+
+
+WORKLOADS = {
+    # name: (builder, sizes for the scaling curve)
+    "transitive_closure": (transitive_closure, [25, 50, 100]),
+    "negation_chain": (negation_chain, [10, 20, 40]),
+    "wide_join": (wide_join, [7, 10, 14]),
+    "temporal_loop": (temporal_loop, [100, 1000, 10000]),
+}
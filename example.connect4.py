@@ -70,7 +70,7 @@ winner_rules = [
 all_rules = setup_rules + player_facts + column_facts + row_facts + top_of_facts + besides_facts + marker_rules + get_drop_rule + phase_rules + winner_rules
 p = Program(all_rules)
 
-for s in p.run_generator(extended_state=True):
+for added, removed, s in p.run_generator(extended_state=True, delta=True):
     if (phase, ("halt",)) in s:
       break
     if (phase, ("print",)) in s:
@@ -1 +1 @@
-from .microlog import START, NEXT, relation, variable, variables, oracle, call, Program
+from .microlog import START, NEXT, relation, variable, variables, oracle, call, Program, Profiler
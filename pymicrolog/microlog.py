@@ -1,3 +1,8 @@
+import pickle
+import queue
+import time
+import weakref
+from collections import namedtuple
 from enum import Enum
 from itertools import zip_longest
 
@@ -16,6 +21,9 @@ class TemporalAnnotation(Enum):
 START = TemporalAnnotation.START
 NEXT = TemporalAnnotation.NEXT
 
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+StateDelta = namedtuple("StateDelta", ["added", "removed", "state"])
+
 
 class Oracle():
     fn = None
@@ -29,42 +37,188 @@ class Oracle():
 
 class Call():
     fn = None
+    memo = None
 
-    def __init__(self, fn):
+    def __init__(self, fn, memo=None):
         self.fn = fn
+        self.memo = memo
 
     def __call__(self, *args):
         return CallFormula(self, args)
 
+    def cache_info(self):
+        if self.memo is None:
+            return None
+        return self.memo.info()
+
+    def cache_clear(self):
+        if self.memo is not None:
+            self.memo.clear()
+
+
+class CallMemo():
+    # results of a call by the function it resolves to and argument tuple, expiring after ttl_cycles cycles or ttl_seconds seconds,
+    # least recently used entries are evicted beyond maxsize
+    ttl_cycles = None
+    ttl_seconds = None
+    maxsize = None
+    entries = None
+    cycle = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, ttl_cycles=None, ttl_seconds=None, maxsize=None):
+        from collections import OrderedDict
+        self.ttl_cycles = ttl_cycles
+        self.ttl_seconds = ttl_seconds
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def tick(self):
+        self.cycle += 1
+
+    def get(self, fn, args):
+        # returns (True, return value) on a hit and (False, None) on a miss; fn is the function the
+        # call resolves to, a fnmapping of another run or Program can resolve it differently
+        key = (fn, args)
+        entry = self.entries.get(key) if is_hashable(args) else None
+        if entry is not None:
+            return_value, cycle, stamp = entry
+            if self.ttl_cycles is not None and self.cycle - cycle >= self.ttl_cycles:
+                entry = None
+            elif self.ttl_seconds is not None and time.monotonic() - stamp >= self.ttl_seconds:
+                entry = None
+            if entry is None:
+                del self.entries[key]
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, return_value
+
+    def put(self, fn, args, return_value):
+        if not is_hashable(args):
+            return
+        key = (fn, args)
+        self.entries[key] = (return_value, self.cycle, time.monotonic())
+        self.entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def __getstate__(self):
+        # cached results belong to the run that produced them
+        from collections import OrderedDict
+        return {"ttl_cycles": self.ttl_cycles, "ttl_seconds": self.ttl_seconds, "maxsize": self.maxsize, "entries": OrderedDict()}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Term():
+    # terms are immutable and hash-consed: building a term equal to a live one returns that one,
+    # so they compare by identity and hash by a value computed once
+    __slots__ = ("cached_hash", "__weakref__")
+    interned = weakref.WeakValueDictionary()
+    has_args = False  # args is the second field
+
+    @classmethod
+    def make(cls, *values):
+        key = (cls, arguments_shape(values[1]) if cls.has_args else None) + values
+        try:
+            term = Term.interned.get(key)
+        except TypeError:
+            return cls.build(values, None)  # unhashable constants, the term is not shared
+        if term is None:
+            term = cls.build(values, hash(key))
+            Term.interned[key] = term
+        return term
+
+    @classmethod
+    def build(cls, values, hash_value):
+        term = object.__new__(cls)
+        for name, value in zip(cls.__slots__, values):
+            object.__setattr__(term, name, value)
+        object.__setattr__(term, "cached_hash", object.__hash__(term) if hash_value is None else hash_value)
+        return term
+
+    def __hash__(self):
+        return self.cached_hash
 
-class Conjunction():
-    literals = None
+    def __setattr__(self, name, value):
+        raise AttributeError("Terms are immutable", name)
 
-    def __init__(self, *literals):
-        self.literals = literals
+    def __delattr__(self, name):
+        raise AttributeError("Terms are immutable", name)
 
-    def reorder(self):
+    def __reduce__(self):
+        return (type(self).make, tuple(getattr(self, name) for name in type(self).__slots__))
 
-        def lit_order(lit):
-            return [
-                Formula, CallFormula, NegatedFormula, NegatedCallFormula, OracleFormula, NegatedOracleFormula
-            ].index(type(lit))
+def arguments_shape(args):
+    # Variable.__eq__ builds an oracle, keys hold the argument types and variable names ahead of the
+    # arguments so that equal keys only ever compare a variable with itself
+    shape = tuple(map(type, args))
+    if Variable in shape:
+        return tuple(arg.varname if type(arg) is Variable else type(arg) for arg in args)
+    return shape
 
-        lits = list(self.literals)
-        lits.sort(key=lit_order)
-        return Conjunction(*lits)
 
-    def substitutions(self, data, partial_substitutions=None, fnmapping=None):
+class Conjunction(Term):
+    __slots__ = ("literals",)
+
+    def __new__(cls, *literals):
+        return cls.make(literals)
+
+    def reorder(self):
+        lits = list(self.literals)
+        return Conjunction(*[lits[n] for n in self.plan(lambda n, bound: 0)])
+
+    def plan(self, estimate):
+        # greedy join order as literal positions, estimate(n, bound varnames) is the expected number of matches
+        positives = [n for n, lit in enumerate(self.literals) if isinstance(lit, (Formula, CallFormula))]
+        filters = [n for n, lit in enumerate(self.literals) if not isinstance(lit, (Formula, CallFormula))]
+        order = []
+        bound = set()
+
+        def place_filters():
+            # negations and oracles go right after the literal binding their last variable
+            for n in list(filters):
+                if all(var.varname in bound for var in self.literals[n].variables()):
+                    filters.remove(n)
+                    order.append(n)
+
+        place_filters()
+        while positives:
+            best = min(positives, key=lambda n: estimate(n, bound))
+            positives.remove(best)
+            order.append(best)
+            bound.update(var.varname for var in self.literals[best].variables())
+            place_filters()
+        rest = [n for n, lit in enumerate(self.literals) if n not in order]
+        rest.sort(key=lambda n: literal_order(self.literals[n]))
+        return order + rest
+
+    def substitutions(self, data, partial_substitutions=None, fnmapping=None, sources=None, start=0):
+        # sources optionally overrides the data per literal, None meaning data; a literal is only
+        # instantiated once the literals before it are matched
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
         fnmapping = {} if fnmapping is None else fnmapping
-        if len(self.literals) == 0:
+        if start == len(self.literals):
             yield partial_substitutions
             return
-        first_lit, *rest = self.literals
-        for subst in first_lit.substitutions(data, partial_substitutions, fnmapping):
+        lit = self.literals[start]
+        if partial_substitutions:
+            lit = lit.apply_substitution(partial_substitutions)
+        source = sources[start] if sources and start < len(sources) else None
+        for subst in lit.substitutions(data if source is None else source, partial_substitutions, fnmapping):
             full_subst = {**subst, **partial_substitutions}
-            new_conjunction = Conjunction(*[other_lits.apply_substitution(full_subst) for other_lits in rest])
-            yield from new_conjunction.substitutions(data, partial_substitutions=full_subst, fnmapping=fnmapping)
+            yield from self.substitutions(data, full_subst, fnmapping, sources, start + 1)
 
     def as_list(self):  # very bad name
         return list(self.literals)
@@ -79,14 +233,20 @@ class Conjunction():
         raise ValueError("Cannot negate Conjunction")
 
 
-class Variable():
-    varname = None
+def literal_order(lit):
+    return [
+        Formula, CallFormula, NegatedFormula, NegatedCallFormula, OracleFormula, NegatedOracleFormula
+    ].index(type(lit))
 
-    def __init__(self, varname):
-        self.varname = varname
+
+class Variable(Term):
+    __slots__ = ("varname",)
+
+    def __new__(cls, varname):
+        return cls.make(varname)
 
     def __hash__(self):
-        return hash((Variable, self.varname))
+        return self.cached_hash
 
     def __repr__(self):
         return "Var({})".format(self.varname)
@@ -138,13 +298,12 @@ class Relation():
         return "R({})".format(self.relname)
 
 
-class Formula():
-    fn = None
-    args = None
+class Formula(Term):
+    __slots__ = ("fn", "args")
+    has_args = True
 
-    def __init__(self, fn, args):
-        self.fn = fn
-        self.args = tuple(args)
+    def __new__(cls, fn, args):
+        return cls.make(fn, tuple(args))
 
     def variables(self):
         return frozenset(arg for arg in self.args if isinstance(arg, Variable))
@@ -173,8 +332,9 @@ class Formula():
         return NegatedFormula(self)
 
     def apply_substitution(self, substitution):
-        new_args = [substitute_argument(arg, substitution) for arg in self.args]
-        return Formula(self.fn, new_args)
+        # instances for a match are short lived and rarely equal to another term, they are not interned
+        new_args = tuple([substitute_argument(arg, substitution) for arg in self.args])
+        return Formula.build((self.fn, new_args), None)
 
     def as_fact(self):
         if self.variables():
@@ -186,37 +346,38 @@ class Formula():
     def substitutions(self, data, partial_substitutions=None, fnmapping=None):
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
         fnmapping = {} if fnmapping is None else fnmapping
+        if not isinstance(data, Model):
+            data = Model(data)
         matches = set()
-        # if there are no variables in self.args, we can just do a simple contains-check, right?
-        for rel, data_args in data:
-            if fnmapping.get(rel, rel) != fnmapping.get(self.fn, self.fn):
-                continue
-            # this data matches function symbol
-            bound_variables = set()
-            single_match = set()
-            for my_arg, data_arg in zip_longest(self.args, data_args):
-                if my_arg is Ellipsis:
-                    continue
-                if isinstance(my_arg, Variable):
-                    var_match = (my_arg, data_arg)
-                    single_match.add(var_match)
-                    bound_variables.add(my_arg)
-                    continue
-                elif my_arg != data_arg:
-                    break
-            else:
-                if len(bound_variables) == len(single_match):
-                    matches.add(frozenset(single_match))
+        # only facts agreeing on the constant arguments need to be looked at
+        positions = tuple(n for n, arg in enumerate(self.args) if arg is not Ellipsis and not isinstance(arg, Variable))
+        key = tuple(self.args[n] for n in positions)
+        for rel in relation_aliases(self.fn, fnmapping):
+            for data_args in data.candidates(rel, positions, key):
+                # this data matches function symbol
+                bound_variables = set()
+                single_match = set()
+                for my_arg, data_arg in zip_longest(self.args, data_args):
+                    if my_arg is Ellipsis:
+                        continue
+                    if isinstance(my_arg, Variable):
+                        var_match = (my_arg, data_arg)
+                        single_match.add(var_match)
+                        bound_variables.add(my_arg)
+                        continue
+                    elif my_arg != data_arg:
+                        break
+                else:
+                    if len(bound_variables) == len(single_match):
+                        matches.add(frozenset(single_match))
         for match in matches:
           yield {**dict(match), **partial_substitutions}
 
-class Rule():
-    head = None
-    body = None
+class Rule(Term):
+    __slots__ = ("head", "body")
 
-    def __init__(self, head, body=None):
-        self.head = head
-        self.body = body
+    def __new__(cls, head, body=None):
+        return cls.make(head, body)
 
     def __repr__(self):
         if self.body is None:
@@ -244,15 +405,12 @@ class Rule():
         return self.head.variables() | self.body.variables()
 
 
-class TempAnnotatedFormula():
-    fn = None
-    args = None
-    temporalAnnotation = None
+class TempAnnotatedFormula(Term):
+    __slots__ = ("fn", "args", "temporalAnnotation")
+    has_args = True
 
-    def __init__(self, formula, annotation):
-        self.fn = formula.fn
-        self.args = formula.args
-        self.temporalAnnotation = annotation
+    def __new__(cls, formula, annotation):
+        return cls.make(formula.fn, formula.args, annotation)
 
     def as_rule(self):
         return Rule(head=self)
@@ -267,16 +425,16 @@ class TempAnnotatedFormula():
         return "{}{}@{}".format(self.fn, repr(self.args), repr(self.temporalAnnotation))
 
     def apply_substitution(self, substitution):
-        return TempAnnotatedFormula(Formula(self.fn, self.args).apply_substitution(substitution), self.temporalAnnotation)
+        new_args = tuple([substitute_argument(arg, substitution) for arg in self.args])
+        return TempAnnotatedFormula.build((self.fn, new_args, self.temporalAnnotation), None)
 
 
-class CallFormula():
-    fn = None
-    args = None
+class CallFormula(Term):
+    __slots__ = ("fn", "args", "memo")
+    has_args = True
 
-    def __init__(self, oracle, args):
-        self.fn = oracle.fn
-        self.args = tuple(args)
+    def __new__(cls, oracle, args):
+        return cls.make(oracle.fn, tuple(args), oracle.memo)
 
     def as_rule(self):
         return Rule(head=self)
@@ -284,6 +442,9 @@ class CallFormula():
     def variables(self):
         return frozenset(arg for arg in self.args if isinstance(arg, Variable))
 
+    def __repr__(self):
+        return "{}{}".format(self.fn, repr(self.args))
+
     def __matmul__(self, other):
         if other is not NEXT:
             raise ValueError()
@@ -302,8 +463,8 @@ class CallFormula():
         return [self]
 
     def apply_substitution(self, substitution):
-        new_args = [substitute_argument(arg, substitution) for arg in self.args]
-        return CallFormula(self, new_args)
+        new_args = tuple([substitute_argument(arg, substitution) for arg in self.args])
+        return CallFormula.build((self.fn, new_args, self.memo), None)
 
     def substitutions(self, data, partial_substitutions=None, fnmapping=None):
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
@@ -312,11 +473,11 @@ class CallFormula():
         yield from Formula(fn, self.args).substitutions(data, partial_substitutions, fnmapping)
         # Here we need to package the call
 
-class NegatedCallFormula():
-    orig = None
+class NegatedCallFormula(Term):
+    __slots__ = ("orig",)
 
-    def __init__(self, orig):
-        self.orig = orig
+    def __new__(cls, orig):
+        return cls.make(orig)
 
     def as_list(self):
         return [self]
@@ -331,20 +492,24 @@ class NegatedCallFormula():
         return Conjunction(*self.as_list(), *other.as_list())
 
     def apply_substitution(self, substitution):
-        return NegatedCallFormula(self.orig.apply_substitution(substitution))
+        return NegatedCallFormula.build((self.orig.apply_substitution(substitution),), None)
 
     def substitutions(self, data, partial_substitutions=None, fnmapping=None):
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
         fnmapping = {} if fnmapping is None else fnmapping
-        for _ in self.orig.substitutions(data, partial_substitutions, fnmapping):
+        matched = projection_match(self.orig, fnmapping[self.orig.fn] if self.orig.fn in fnmapping else self.orig.fn, data, fnmapping)
+        if matched is None:
+            for _ in self.orig.substitutions(data, partial_substitutions, fnmapping):
+                return
+        elif matched:
             return
         yield partial_substitutions
 
-class NegatedFormula():
-    orig = None
+class NegatedFormula(Term):
+    __slots__ = ("orig",)
 
-    def __init__(self, orig):
-        self.orig = orig
+    def __new__(cls, orig):
+        return cls.make(orig)
 
     def as_list(self):
         return [self]
@@ -359,21 +524,25 @@ class NegatedFormula():
         return Conjunction(*self.as_list(), *other.as_list())
 
     def apply_substitution(self, substitution):
-        return NegatedFormula(self.orig.apply_substitution(substitution))
+        return NegatedFormula.build((self.orig.apply_substitution(substitution),), None)
 
     def substitutions(self, data, partial_substitutions=None, fnmapping=None):
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
         fnmapping = {} if fnmapping is None else fnmapping
-        for _ in self.orig.substitutions(data, partial_substitutions, fnmapping):
+        matched = projection_match(self.orig, self.orig.fn, data, fnmapping)
+        if matched is None:
+            for _ in self.orig.substitutions(data, partial_substitutions, fnmapping):
+                return
+        elif matched:
             return
         yield partial_substitutions
 
 
-class NegatedOracleFormula():
-    orig = None
+class NegatedOracleFormula(Term):
+    __slots__ = ("orig",)
 
-    def __init__(self, orig):
-        self.orig = orig
+    def __new__(cls, orig):
+        return cls.make(orig)
 
     def as_list(self):
         return [self]
@@ -391,8 +560,7 @@ class NegatedOracleFormula():
         return not self.orig.eval()
 
     def apply_substitution(self, substitution):
-        substituted = self.orig.apply_substitution(substitution)
-        return ~substituted
+        return NegatedOracleFormula.build((self.orig.apply_substitution(substitution),), None)
 
     def substitutions(self, data, partial_substitutions=None, fnmapping=None):
         partial_substitutions = {} if partial_substitutions is None else partial_substitutions
@@ -401,22 +569,45 @@ class NegatedOracleFormula():
             return
         yield partial_substitutions
 
+def projection_match(formula, fn, data, fnmapping):
+    # anti-join probe for a formula without variables, None when it cannot be answered that way
+    if not isinstance(data, Model) or any(isinstance(arg, Variable) for arg in formula.args):
+        return None
+    positions = tuple(n for n, arg in enumerate(formula.args) if arg is not Ellipsis)
+    key = tuple(formula.args[n] for n in positions)
+    if not is_hashable(key):
+        return None
+    return key in data.projection(relation_aliases(fn, fnmapping), positions, len(formula.args))
+
+def match_head(head, args):
+    # the substitution instantiating head to args, None if there is none
+    if len(head.args) != len(args):
+        return None
+    substitution = {}
+    for head_arg, arg in zip(head.args, args):
+        if isinstance(head_arg, Variable):
+            if head_arg in substitution and substitution[head_arg] != arg:
+                return None
+            substitution[head_arg] = arg
+        elif head_arg != arg:
+            return None
+    return substitution
+
 def substitute_argument(arg, substitution):
     if isinstance(arg, Variable) and arg in substitution:
         return substitution[arg]
     return arg
 
-class OracleFormula():
-    fn = None
-    args = None
+class OracleFormula(Term):
+    __slots__ = ("fn", "args")
+    has_args = True
 
-    def __init__(self, oracle, args):
-        self.fn = oracle.fn
-        self.args = args
+    def __new__(cls, oracle, args):
+        return cls.make(oracle.fn, tuple(args))
 
     def apply_substitution(self, substitution):
-        new_args = [substitute_argument(arg, substitution) for arg in self.args]
-        return OracleFormula(self, new_args)
+        new_args = tuple([substitute_argument(arg, substitution) for arg in self.args])
+        return OracleFormula.build((self.fn, new_args), None)
 
     def as_list(self):
         return [self]
@@ -443,20 +634,848 @@ class OracleFormula():
         if fn(*self.args):
             yield partial_substitutions
 
+class Model():
+    partitions = None
+    indexes = None
+    projections = None
+    tables = None
+    size = 0
+    base = None
+
+    def __init__(self, facts=(), base=None):
+        # facts of base are visible but never changed through this model
+        self.partitions = {}
+        self.indexes = {}
+        self.projections = {}
+        self.tables = {}
+        self.size = 0
+        self.base = base
+        self.update(facts)
+
+    def add(self, fact):
+        if self.base is not None and fact in self.base:
+            return False
+        rel, args = fact
+        partition = self.partitions.get(rel)
+        if partition is None:
+            partition = self.partitions[rel] = set()
+        elif args in partition:
+            return False
+        partition.add(args)
+        self.size += 1
+        for positions, index in self.indexes.get(rel, {}).items():
+            index.setdefault(index_key(args, positions), set()).add(args)
+        for (positions, length), projection in self.projections.get(rel, {}).items():
+            if len(args) == length or pad_args(args, length) is not None:
+                key = index_key(args, positions)
+                projection[key] = projection.get(key, 0) + 1
+        for table in self.tables.get(rel, {}).values():
+            table.add(args)
+        return True
+
+    def discard(self, fact):
+        rel, args = fact
+        partition = self.partitions.get(rel)
+        if not partition or args not in partition:
+            return False
+        partition.remove(args)
+        for table in self.tables.get(rel, {}).values():
+            table.discard(args)
+        self.size -= 1
+        for positions, index in self.indexes.get(rel, {}).items():
+            key = index_key(args, positions)
+            bucket = index[key]
+            bucket.discard(args)
+            if not bucket:
+                del index[key]
+        for (positions, length), projection in self.projections.get(rel, {}).items():
+            if len(args) == length or pad_args(args, length) is not None:
+                key = index_key(args, positions)
+                projection[key] -= 1
+                if not projection[key]:
+                    del projection[key]
+        return True
+
+    def update(self, facts):
+        added = 0
+        for fact in facts:
+            if self.add(fact):
+                added += 1
+        return added
+
+    def lookup(self, rels, positions=(), key=()):
+        if len(rels) == 1:
+            return self.candidates(rels[0], positions, key)
+        return [args for rel in rels for args in self.candidates(rel, positions, key)]
+
+    def projection(self, rels, positions, length):
+        # the keys on positions of the facts a literal with length arguments can match, for anti-joins
+        if len(rels) != 1:
+            keys = set()
+            for rel in rels:
+                keys.update(self.projection((rel,), positions, length))
+            return keys
+        rel, = rels
+        if self.base is not None and self.base.count(rel):
+            if not self.partitions.get(rel):
+                return self.base.projection(rels, positions, length)
+            return set(self.base.projection(rels, positions, length)) | set(self.local_projection(rel, positions, length))
+        return self.local_projection(rel, positions, length)
+
+    def local_projection(self, rel, positions, length):
+        rel_projections = self.projections.setdefault(rel, {})
+        projection = rel_projections.get((positions, length))
+        if projection is None:
+            projection = {}
+            for args in self.partitions.get(rel, ()):
+                if len(args) == length or pad_args(args, length) is not None:
+                    key = index_key(args, positions)
+                    projection[key] = projection.get(key, 0) + 1
+            rel_projections[(positions, length)] = projection
+        return projection
+
+    def numeric_table(self, rels, length):
+        # the facts of rels as one 2d array for the NumPy backend, None unless they all have
+        # length args and are all ints or all floats
+        tables = []
+        for rel in rels:
+            if self.base is not None and self.base.count(rel):
+                tables.append(self.base.numeric_table((rel,), length))
+            if self.partitions.get(rel):
+                tables.append(self.local_table(rel, length))
+        return concatenate_tables(tables, length)
+
+    def local_table(self, rel, length):
+        rel_tables = self.tables.setdefault(rel, {})
+        table = rel_tables.get(length)
+        if table is None:
+            table = rel_tables[length] = NumericTable(self.partitions[rel], length)
+        return table.view()
+
+    def distinct(self, rel, positions):
+        # number of distinct keys on positions if that index is built
+        if self.base is not None and self.base.count(rel):
+            return None if self.partitions.get(rel) else self.base.distinct(rel, positions)
+        index = self.indexes.get(rel, {}).get(positions)
+        return None if index is None else len(index)
+
+    def facts(self, rel):
+        if self.base is not None and self.base.count(rel):
+            if not self.partitions.get(rel):
+                return self.base.facts(rel)
+            return [*self.base.facts(rel), *self.partitions[rel]]
+        return self.partitions.get(rel, ())
+
+    def count(self, rel):
+        if self.base is not None:
+            return len(self.partitions.get(rel, ())) + self.base.count(rel)
+        return len(self.partitions.get(rel, ()))
+
+    def candidates(self, rel, positions=(), key=()):
+        # the facts of rel whose args at positions equal key
+        if self.base is not None and self.base.count(rel):
+            if not self.partitions.get(rel):
+                return self.base.candidates(rel, positions, key)
+            return [*self.base.candidates(rel, positions, key), *self.local_candidates(rel, positions, key)]
+        return self.local_candidates(rel, positions, key)
+
+    def local_candidates(self, rel, positions, key):
+        partition = self.partitions.get(rel)
+        if not partition:
+            return ()
+        if not positions:
+            return partition
+        rel_indexes = self.indexes.setdefault(rel, {})
+        index = rel_indexes.get(positions)
+        if index is None:
+            index = {}
+            for args in partition:
+                index.setdefault(index_key(args, positions), set()).add(args)
+            rel_indexes[positions] = index
+        try:
+            return index.get(key, ())
+        except TypeError:  # unhashable constant
+            return [args for args in partition if index_key(args, positions) == key]
+
+    def __contains__(self, fact):
+        rel, args = fact
+        return args in self.partitions.get(rel, ()) or (self.base is not None and fact in self.base)
+
+    def __iter__(self):
+        for rel, partition in self.partitions.items():
+            for args in partition:
+                yield (rel, args)
+        if self.base is not None:
+            yield from self.base
+
+    def __len__(self):
+        if self.base is not None:
+            return self.size + len(self.base)
+        return self.size
+
+    def __or__(self, other):
+        model = Model(self)
+        model.update(other)
+        return model
+
+    def __sub__(self, other):
+        return set(fact for fact in self if fact not in other)
+
+    def __rsub__(self, other):
+        return set(fact for fact in other if fact not in self)
+
+    def __repr__(self):
+        return "Model({})".format(repr(set(self)))
+
+class ModelUnion():
+    models = None
+
+    def __init__(self, *models):
+        self.models = models
+
+    def candidates(self, rel, positions=(), key=()):
+        return [args for model in self.models for args in model.candidates(rel, positions, key)]
+
+    def lookup(self, rels, positions=(), key=()):
+        return [args for model in self.models for args in model.lookup(rels, positions, key)]
+
+    def projection(self, rels, positions, length):
+        keys = set()
+        for model in self.models:
+            keys.update(model.projection(rels, positions, length))
+        return keys
+
+    def distinct(self, rel, positions):
+        return None
+
+    def numeric_table(self, rels, length):
+        return concatenate_tables([model.numeric_table(rels, length) for model in self.models], length)
+
+    def facts(self, rel):
+        return [args for model in self.models for args in model.facts(rel)]
+
+    def count(self, rel):
+        return sum(model.count(rel) for model in self.models)
+
+    def __contains__(self, fact):
+        return any(fact in model for model in self.models)
+
+    def __iter__(self):
+        for model in self.models:
+            yield from model
+
+    def __len__(self):
+        return sum(len(model) for model in self.models)
+
+def index_key(args, positions):
+    # missing arguments compare as None, just like zip_longest in Formula.substitutions
+    return tuple(args[n] if n < len(args) else None for n in positions)
+
+def relation_aliases(fn, fnmapping):
+    # every relation key in a model that fnmapping resolves to the same target as fn
+    if not fnmapping:
+        return (fn,)
+    target = fnmapping.get(fn, fn)
+    aliases = [rel for rel, mapped in fnmapping.items() if rel is not target and mapped is target]
+    if fnmapping.get(target, target) is target:
+        aliases.append(target)
+    return aliases
+
+def pad_args(args, length):
+    # the zip_longest view of args on a literal with length arguments, None if it cannot match
+    if len(args) > length:
+        if any(arg is not None for arg in args[length:]):
+            return None
+        return args[:length]
+    return args + (None,) * (length - len(args))
+
+def exists_match(data, rels, pattern):
+    for rel in rels:
+        for _ in Formula(rel, pattern).substitutions(data):
+            return True
+    return False
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def exists_bound(data, rels, positions, key, length):
+    for args in data.lookup(rels, positions, key):
+        if len(args) == length or pad_args(args, length) is not None:
+            return True
+    return False
+
+
+MAX_COMPILED_JOINS = 18  # python limits the number of nested loops
+
+
+class CompiledRule():
+    rule = None
+    source = None
+    code = None
+    constants = None
+    factory = None
+
+    def __init__(self, rule):
+        if rule.body is not None and sum(isinstance(lit, (Formula, CallFormula)) for lit in rule.body.as_list()) > MAX_COMPILED_JOINS:
+            raise ValueError("Too many joins to compile", rule)
+        self.rule = rule
+        self.constants = {}
+        self.source = self.generate()
+        self.code = compile(self.source, "<rule {}>".format(repr(rule)), "exec")
+        self.build()
+
+    def build(self):
+        namespace = {
+            "relation_aliases": relation_aliases,
+            "pad_args": pad_args,
+            "exists_match": exists_match,
+            "exists_bound": exists_bound,
+            **self.constants
+        }
+        exec(self.code, namespace)
+        self.factory = namespace["make"]
+
+    def __getstate__(self):
+        # the factory is rebuilt from the bytecode, or from the source on another Python version
+        import importlib.util
+        import marshal
+        return {"rule": self.rule, "source": self.source, "constants": self.constants,
+                "code": (importlib.util.MAGIC_NUMBER, marshal.dumps(self.code))}
+
+    def __setstate__(self, state):
+        import importlib.util
+        import marshal
+        magic, code = state.pop("code")
+        self.__dict__.update(state)
+        if magic == importlib.util.MAGIC_NUMBER:
+            self.code = marshal.loads(code)
+        else:
+            self.code = compile(self.source, "<rule {}>".format(repr(self.rule)), "exec")
+        self.build()
+
+    def bind(self, fnmapping):
+        # resolve fnmapping once per run, returns fn(model, out, sources=None) -> #substitutions
+        return self.factory(fnmapping)
+
+    def constant(self, value):
+        name = "c{}".format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def generate(self):
+        rule = self.rule
+        literals = [] if rule.body is None else rule.body.as_list()
+        resolve = ["def make(fnmapping):"]
+        prologue = ["    def rule(model, out, sources=None):"]
+        body = []
+        slots = {}
+
+        def term(arg):
+            if isinstance(arg, Variable) and arg.varname in slots:
+                return slots[arg.varname]
+            return self.constant(arg)
+
+        def key_of(lit):
+            positions = tuple(n for n, arg in enumerate(lit.args) if arg is not Ellipsis and (
+                not isinstance(arg, Variable) or arg.varname in slots))
+            return positions, "({}{})".format(", ".join(term(lit.args[n]) for n in positions), "," if len(positions) == 1 else "")
+
+        depth = 2
+        for n, lit in enumerate(literals):
+            indent = "    " * depth
+            if isinstance(lit, (Formula, CallFormula, NegatedFormula, NegatedCallFormula)):
+                orig = lit.orig if isinstance(lit, (NegatedFormula, NegatedCallFormula)) else lit
+                fn = self.constant(orig.fn)
+                if isinstance(orig, CallFormula):
+                    resolve.append("    r{n} = relation_aliases(fnmapping[{fn}] if {fn} in fnmapping else {fn}, fnmapping)".format(n=n, fn=fn))
+                else:
+                    resolve.append("    r{n} = relation_aliases({fn}, fnmapping)".format(n=n, fn=fn))
+                prologue.append("        d{n} = model if sources is None or sources[{n}] is None else sources[{n}]".format(n=n))
+            if isinstance(lit, (Formula, CallFormula)):
+                positions, key = key_of(lit)
+                length = len(lit.args)
+                # projections yield the same binding for several facts
+                project = any(arg is Ellipsis for arg in lit.args) and any(isinstance(arg, Variable) and arg.varname not in slots for arg in lit.args)
+                if project:
+                    body.append("{i}seen{n} = set()".format(i=indent, n=n))
+                body.append("{i}for a{n} in d{n}.lookup(r{n}, {p}, {k}):".format(i=indent, n=n, p=repr(positions), k=key))
+                indent += "    "
+                body.append("{i}if len(a{n}) != {l}:".format(i=indent, n=n, l=length))
+                body.append("{i}    a{n} = pad_args(a{n}, {l})".format(i=indent, n=n, l=length))
+                body.append("{i}    if a{n} is None:".format(i=indent, n=n))
+                body.append("{i}        continue".format(i=indent))
+                bound_here = []
+                for m, arg in enumerate(lit.args):
+                    if not isinstance(arg, Variable) or m in positions:
+                        continue
+                    if arg.varname in slots:  # repeated within this literal
+                        body.append("{i}if a{n}[{m}] != {v}:".format(i=indent, n=n, m=m, v=slots[arg.varname]))
+                        body.append("{i}    continue".format(i=indent))
+                        continue
+                    slots[arg.varname] = "v{}".format(len(slots))
+                    bound_here.append(slots[arg.varname])
+                    body.append("{i}{v} = a{n}[{m}]".format(i=indent, v=slots[arg.varname], n=n, m=m))
+                if project:
+                    body.append("{i}if ({v},) in seen{n}:".format(i=indent, v=", ".join(bound_here), n=n))
+                    body.append("{i}    continue".format(i=indent))
+                    body.append("{i}seen{n}.add(({v},))".format(i=indent, v=", ".join(bound_here), n=n))
+                depth += 1
+            elif isinstance(lit, (NegatedFormula, NegatedCallFormula)):
+                skip = "continue" if depth > 2 else "return n"
+                orig = lit.orig
+                if all(arg is Ellipsis or not isinstance(arg, Variable) or arg.varname in slots for arg in orig.args):
+                    positions, key = key_of(orig)
+                    if all(is_hashable(orig.args[m]) for m in positions):
+                        # anti-join against the hashed projection of the negated relation
+                        prologue.append("        p{n} = d{n}.projection(r{n}, {p}, {l})".format(n=n, p=repr(positions), l=len(orig.args)))
+                        body.append("{i}if {k} in p{n}:".format(i=indent, k=key, n=n))
+                    else:
+                        body.append("{i}if exists_bound(d{n}, r{n}, {p}, {k}, {l}):".format(i=indent, n=n, p=repr(positions), k=key, l=len(orig.args)))
+                else:
+                    pattern = "({},)".format(", ".join("..." if arg is Ellipsis else term(arg) for arg in orig.args)) if orig.args else "()"
+                    body.append("{i}if exists_match(d{n}, r{n}, {p}):".format(i=indent, n=n, p=pattern))
+                body.append("{i}    {s}".format(i=indent, s=skip))
+            elif isinstance(lit, (OracleFormula, NegatedOracleFormula)):
+                skip = "continue" if depth > 2 else "return n"
+                orig = lit.orig if isinstance(lit, NegatedOracleFormula) else lit
+                fn = self.constant(orig.fn)
+                resolve.append("    o{n} = fnmapping[{fn}] if {fn} in fnmapping else {fn}".format(n=n, fn=fn))
+                call = "o{n}({a})".format(n=n, a=", ".join(term(arg) for arg in orig.args))
+                body.append("{i}if {neg}{call}:".format(i=indent, neg="" if isinstance(lit, NegatedOracleFormula) else "not ", call=call))
+                body.append("{i}    {s}".format(i=indent, s=skip))
+            else:
+                raise ValueError("Unsupported literal", lit)
+        head = rule.head
+        fn = self.constant(head.fn)
+        resolve.append("    h = fnmapping[{fn}] if {fn} in fnmapping else {fn}".format(fn=fn))
+        args = ", ".join(term(arg) for arg in head.args)
+        indent = "    " * depth
+        body.append("{i}n += 1".format(i=indent))
+        body.append("{i}out.add((h, ({a}{c})))".format(i=indent, a=args, c="," if len(head.args) == 1 else ""))
+        return "\n".join(resolve + prologue + ["        n = 0"] + body + ["        return n", "    return rule", ""])
+
+def rule_slots(rule):
+    # dense slot numbers for the variables of a rule, in order of appearance
+    slots = {}
+    for lit in [rule.head] + ([] if rule.body is None else rule.body.as_list()):
+        orig = lit.orig if isinstance(lit, (NegatedFormula, NegatedCallFormula, NegatedOracleFormula)) else lit
+        for arg in orig.args:
+            if isinstance(arg, Variable) and arg.varname not in slots:
+                slots[arg.varname] = len(slots)
+    return slots
+
+
+class FrameRule():
+    # interprets a rule the way CompiledRule generates it: variables live in a list frame at
+    # their slot and are bound in place by the join, terms are (slot, None) or (None, constant)
+    rule = None
+    slots = None
+    steps = None
+    head = None
+
+    def __init__(self, rule, slots):
+        self.rule = rule
+        self.slots = slots
+        self.steps = []
+        bound = set()
+
+        def term(arg):
+            if isinstance(arg, Variable) and arg.varname in bound:
+                return (slots[arg.varname], None)
+            return (None, arg)
+
+        def key_of(lit):
+            positions = tuple(n for n, arg in enumerate(lit.args) if arg is not Ellipsis and (
+                not isinstance(arg, Variable) or arg.varname in bound))
+            return positions, tuple(term(lit.args[n]) for n in positions)
+
+        for lit in ([] if rule.body is None else rule.body.as_list()):
+            if isinstance(lit, (Formula, CallFormula)):
+                positions, key = key_of(lit)
+                binds = []
+                checks = []
+                for m, arg in enumerate(lit.args):
+                    if not isinstance(arg, Variable) or m in positions:
+                        continue
+                    if arg.varname in bound:  # repeated within this literal
+                        checks.append((m, slots[arg.varname]))
+                        continue
+                    bound.add(arg.varname)
+                    binds.append((m, slots[arg.varname]))
+                # projections yield the same binding for several facts
+                project = any(arg is Ellipsis for arg in lit.args) and bool(binds)
+                self.steps.append(("join", lit.fn, isinstance(lit, CallFormula), positions, key, len(lit.args), binds, checks, project))
+            elif isinstance(lit, (NegatedFormula, NegatedCallFormula)):
+                orig = lit.orig
+                call = isinstance(orig, CallFormula)
+                if all(arg is Ellipsis or not isinstance(arg, Variable) or arg.varname in bound for arg in orig.args):
+                    positions, key = key_of(orig)
+                    hashable = all(is_hashable(orig.args[m]) for m in positions)
+                    self.steps.append(("anti", orig.fn, call, positions, key, len(orig.args), hashable))
+                else:
+                    self.steps.append(("absent", orig.fn, call, tuple(term(arg) for arg in orig.args)))
+            elif isinstance(lit, (OracleFormula, NegatedOracleFormula)):
+                orig = lit.orig if isinstance(lit, NegatedOracleFormula) else lit
+                self.steps.append(("oracle", orig.fn, isinstance(lit, NegatedOracleFormula), tuple(term(arg) for arg in orig.args)))
+            else:
+                raise ValueError("Unsupported literal", lit)
+        self.head = (rule.head.fn, tuple(term(arg) for arg in rule.head.args))
+
+    def bind(self, fnmapping):
+        # resolve fnmapping once per run, returns fn(model, out, sources=None) -> #substitutions
+        steps = []
+        for kind, fn, *rest in self.steps:
+            if kind == "oracle":
+                steps.append((kind, fnmapping[fn] if fn in fnmapping else fn, *rest))
+                continue
+            call, *rest = rest
+            if call:  # call results are stored under the mapped function
+                fn = fnmapping[fn] if fn in fnmapping else fn
+            steps.append((kind, relation_aliases(fn, fnmapping), *rest))
+        fn, head_terms = self.head
+        head = fnmapping[fn] if fn in fnmapping else fn
+        size = len(self.slots)
+        last = len(steps)
+
+        def rule(model, out, sources=None):
+            frame = [None] * size
+            data = [model if sources is None or sources[n] is None else sources[n] for n in range(last)]
+            projections = [data[n].projection(step[1], step[2], step[4]) if step[0] == "anti" and step[5] else None
+                           for n, step in enumerate(steps)]
+
+            def run(i):
+                if i == last:
+                    out.add((head, tuple([frame[s] if s is not None else c for s, c in head_terms])))
+                    return 1
+                step = steps[i]
+                kind = step[0]
+                if kind == "join":
+                    _, rels, positions, key, length, binds, checks, project = step
+                    key = tuple([frame[s] if s is not None else c for s, c in key])
+                    seen = set() if project else None
+                    n = 0
+                    for args in data[i].lookup(rels, positions, key):
+                        if len(args) != length:
+                            args = pad_args(args, length)
+                            if args is None:
+                                continue
+                        for m, s in binds:
+                            frame[s] = args[m]
+                        if checks and any(args[m] != frame[s] for m, s in checks):
+                            continue
+                        if project:
+                            values = tuple([frame[s] for m, s in binds])
+                            if values in seen:
+                                continue
+                            seen.add(values)
+                        n += run(i + 1)
+                    return n
+                if kind == "anti":
+                    _, rels, positions, key, length, hashable = step
+                    key = tuple([frame[s] if s is not None else c for s, c in key])
+                    if key in projections[i] if hashable else exists_bound(data[i], rels, positions, key, length):
+                        return 0
+                elif kind == "absent":
+                    pattern = tuple([frame[s] if s is not None else c for s, c in step[2]])
+                    if exists_match(data[i], step[1], pattern):
+                        return 0
+                else:
+                    _, fn, negated, terms = step
+                    if bool(fn(*[frame[s] if s is not None else c for s, c in terms])) == negated:
+                        return 0
+                return run(i + 1)
+
+            return run(0)
+        return rule
+
+VECTORIZE_MIN_FACTS = 256
+PARTITION_MIN_FACTS = 4096
+
+class VectorizedRule():
+    rule = None
+
+    def __init__(self, rule):
+        # only positive relation literals and comparisons over variables and numbers
+        literals = [] if rule.body is None else rule.body.as_list()
+        if not any(isinstance(lit, Formula) for lit in literals):
+            raise ValueError("Nothing to join", rule)
+        for lit in literals:
+            if isinstance(lit, Formula):
+                args = lit.args
+            elif isinstance(lit, (OracleFormula, NegatedOracleFormula)):
+                args = (lit.orig if isinstance(lit, NegatedOracleFormula) else lit).args
+                if len(args) != 2:
+                    raise ValueError("Not a comparison", lit)
+            else:
+                raise ValueError("Unsupported literal", lit)
+            for arg in args:
+                if not isinstance(arg, Variable) and type(arg) not in (int, float):
+                    raise ValueError("Not a numeric term", arg)
+        self.rule = rule
+
+    def evaluate(self, model, out, sources, fnmapping):
+        # the number of substitutions, None when the facts are not numeric and the rule is left to Python
+        import numpy
+        import operator
+        comparisons = (operator.lt, operator.le, operator.eq, operator.ne, operator.ge, operator.gt)
+        literals = self.rule.body.as_list()
+        data = [model if sources is None or sources[n] is None else sources[n] for n in range(len(literals))]
+        if max(sum(data[n].count(rel) for rel in relation_aliases(lit.fn, fnmapping))
+               for n, lit in enumerate(literals) if isinstance(lit, Formula)) < VECTORIZE_MIN_FACTS:
+            return None
+        columns = {}
+        rows = None
+        for n, lit in enumerate(literals):
+            if isinstance(lit, Formula):
+                table = data[n].numeric_table(relation_aliases(lit.fn, fnmapping), len(lit.args))
+                if table is None:
+                    return None
+                mask = numpy.ones(len(table), dtype=bool)
+                found = {}
+                for m, arg in enumerate(lit.args):
+                    if not isinstance(arg, Variable):
+                        mask &= table[:, m] == arg
+                    elif arg.varname in found:  # repeated within this literal
+                        mask &= table[:, m] == table[:, found[arg.varname]]
+                    else:
+                        found[arg.varname] = m
+                table = table[mask]
+                if rows is None:
+                    columns = {var: table[:, m] for var, m in found.items()}
+                else:
+                    shared = [var for var in found if var in columns]
+                    left, right = equi_join([columns[var] for var in shared], [table[:, found[var]] for var in shared], rows, len(table))
+                    columns = {var: column[left] for var, column in columns.items()}
+                    columns.update((var, table[right, m]) for var, m in found.items() if var not in columns)
+                rows = len(table) if rows is None else len(left)
+            else:
+                orig = lit.orig if isinstance(lit, NegatedOracleFormula) else lit
+                fn = fnmapping[orig.fn] if orig.fn in fnmapping else orig.fn
+                if fn not in comparisons:
+                    return None
+                operands = []
+                for arg in orig.args:
+                    if isinstance(arg, Variable):
+                        if arg.varname not in columns:
+                            return None
+                        operands.append(columns[arg.varname])
+                    else:
+                        operands.append(arg)
+                mask = numpy.asarray(fn(*operands), dtype=bool)
+                if isinstance(lit, NegatedOracleFormula):
+                    mask = ~mask
+                if rows is None:
+                    if not mask:
+                        return 0
+                    continue
+                mask = numpy.broadcast_to(mask, (rows,))
+                columns = {var: column[mask] for var, column in columns.items()}
+                rows = int(numpy.count_nonzero(mask))
+            if not rows:
+                return 0
+        head = self.rule.head
+        h = fnmapping[head.fn] if head.fn in fnmapping else head.fn
+        if not head.args:
+            out.add((h, ()))
+            return rows
+        from itertools import repeat
+        values = [columns[arg.varname].tolist() if isinstance(arg, Variable) else repeat(arg, rows) for arg in head.args]
+        out.update((h, args) for args in zip(*values))
+        return rows
+
+class NumericTable():
+    # the args of a partition as the rows of a 2d array, kept in step with the partition by
+    # Model.add and Model.discard so the NumPy backend does not convert relations per evaluation;
+    # added facts are collected and appended in bulk when the table is next read
+    length = None
+    type = None
+    array = None
+    count = 0
+    rows = None
+    args = None
+    pending = None
+    other = None
+
+    def __init__(self, facts, length):
+        import numpy
+        self.length = length
+        self.array = numpy.empty((0, length), dtype=numpy.int64)
+        self.rows = {}
+        self.args = []
+        self.pending = dict.fromkeys(facts)
+        self.other = set()
+
+    def add(self, args):
+        self.pending[args] = None
+
+    def discard(self, args):
+        if args in self.pending:
+            del self.pending[args]
+            return
+        row = self.rows.pop(args, None)
+        if row is None:
+            self.other.discard(args)
+            return
+        last = self.count - 1
+        if row != last:
+            # the last row fills the gap so the array stays dense
+            moved = self.args[last]
+            self.array[row] = self.array[last]
+            self.args[row] = moved
+            self.rows[moved] = row
+        self.args.pop()
+        self.count = last
+
+    def view(self):
+        # the rows as an array, None while any fact is not numeric or of another type than the
+        # rest; only valid until the table changes
+        self.flush()
+        if self.other and not self.count:
+            # the facts may all fit under another type now
+            self.pending = dict.fromkeys(self.other)
+            self.other = set()
+            self.flush()
+        if self.other:
+            return None
+        return self.array[:self.count]
+
+    def flush(self):
+        if not self.pending:
+            return
+        import numpy
+        from itertools import chain
+        facts = list(self.pending)
+        self.pending = {}
+        if not self.count:
+            # an empty table takes the type of the facts it is given
+            self.type = int if not self.length else next(
+                (type(args[0]) for args in facts if len(args) == self.length and type(args[0]) in (int, float)), None)
+            self.array = numpy.empty((0, self.length), dtype=numpy.float64 if self.type is float else numpy.int64)
+        if self.type is None:
+            self.other.update(facts)
+            return
+        array = None
+        if set(map(len, facts)) == {self.length} and set(map(type, chain.from_iterable(facts))) <= {self.type}:
+            try:
+                array = numpy.array(facts, dtype=self.array.dtype).reshape(len(facts), self.length)
+            except OverflowError:
+                pass
+            if array is not None and self.type is float and numpy.isnan(array).any():
+                array = None
+        if array is None:
+            fitting = [args for args in facts if self.fits(args)]
+            self.other.update(args for args in facts if not self.fits(args))
+            facts = fitting
+            array = numpy.array(facts, dtype=self.array.dtype).reshape(len(facts), self.length)
+        end = self.count + len(facts)
+        if end > len(self.array):
+            # grow by doubling so appending stays amortised linear
+            grown = numpy.empty((max(16, 2 * end), self.length), dtype=self.array.dtype)
+            grown[:self.count] = self.array[:self.count]
+            self.array = grown
+        self.array[self.count:end] = array
+        self.rows.update(zip(facts, range(self.count, end)))
+        self.args.extend(facts)
+        self.count = end
+
+    def fits(self, args):
+        if len(args) != self.length or any(type(value) is not self.type for value in args):
+            return False
+        if self.type is int:
+            return all(-2 ** 63 <= value < 2 ** 63 for value in args)
+        return all(value == value for value in args)  # no NaN
+
+def concatenate_tables(tables, length):
+    # one 2d array of the given tables, None if any of them is None or their types differ
+    import numpy
+    if not tables:
+        return numpy.empty((0, length), dtype=numpy.int64)
+    if len(tables) == 1:
+        return tables[0]
+    if any(table is None for table in tables) or len(set(table.dtype for table in tables)) > 1:
+        return None
+    return numpy.concatenate(tables)
+
+def equi_join(left, right, nleft, nright):
+    # row indices of all pairs whose key columns are equal, by sorting the right side
+    import numpy
+    if not left:
+        return numpy.repeat(numpy.arange(nleft), nright), numpy.tile(numpy.arange(nright), nleft)
+    if len(left) == 1:
+        left_codes, right_codes = left[0], right[0]
+    else:
+        codes = key_codes([numpy.concatenate(pair) for pair in zip(left, right)])
+        left_codes, right_codes = codes[:nleft], codes[nleft:]
+    order = numpy.argsort(right_codes)
+    sorted_codes = right_codes[order]
+    lo = numpy.searchsorted(sorted_codes, left_codes, "left")
+    counts = numpy.searchsorted(sorted_codes, left_codes, "right") - lo
+    left_rows = numpy.repeat(numpy.arange(nleft), counts)
+    starts = numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+    return left_rows, order[starts + numpy.arange(len(left_rows))]
+
+def key_codes(columns):
+    # one int64 per row, equal exactly for rows with equal values in all columns; int columns
+    # are offset into a mixed radix number, sorting whole rows is only needed when it overflows
+    import numpy
+    codes = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    span = 1
+    for column in columns:
+        if column.dtype.kind == "i" and len(column):
+            low = int(column.min())
+            size = int(column.max()) - low + 1
+            digits = column - low if size < 2 ** 62 else None
+        else:
+            digits = None
+        if digits is None:
+            uniques, digits = numpy.unique(column, return_inverse=True)
+            size = len(uniques)
+        span *= size
+        if span >= 2 ** 62:
+            return numpy.unique(numpy.column_stack(columns), axis=0, return_inverse=True)[1].reshape(-1)
+        codes = codes * size + digits.reshape(-1)
+    return codes
+
 class Program():
     rules = None  # we can calculate this from the rest
     strata = None
     initial = None
     always = None
     next = None
+    unrewritten = None  # the program without the magic sets rewrite
 
     def __init__(self,
                  rules,
                  name=None,
                  fnmapping=dict(),
-                 reorder_bodies=True):
+                 reorder_bodies=True,
+                 seminaive=True,
+                 compile_rules=True,
+                 plan_joins=True,
+                 incremental=False,
+                 materialize_static=True,
+                 backend="python",
+                 magic_sets=False):
+        if backend not in ("python", "numpy"):
+            raise ValueError("Unknown backend", backend)
+        if backend == "numpy":
+            import numpy  # noqa: F401, fail early when it is missing
+        self.backend = backend
+        self.vectorized = {}
         self.fnmapping = fnmapping
+        self.seminaive = seminaive
+        self.incremental = incremental
+        self.maintenance = {}
+        self.compile_rules = compile_rules
+        self.plan_joins = reorder_bodies and plan_joins
+        self.plans = {}
+        self.planned = {}
         rules = list(rule.as_rule() for rule in rules)
+        given = list(rules)
         for rule in rules:
             if not rule.is_range_restricted():
                 raise ValueError("Rule Not Range Restricted", repr(rule))
@@ -502,21 +1521,35 @@ class Program():
                 raise ValueError("Unsupported rule head", rule.head)
         assert numberOfRules == len(self.initial) + len(self.next) + len(
             self.always) + len(unstratified)
-        # Create dependency graph
-        deps = set()
+
+        if magic_sets:
+            # only derive the facts the NEXT rules can use, static relations are left alone;
+            # runs aliasing other relations through their fnmapping use the rules as given
+            self.unrewritten = Program(given, name, fnmapping, reorder_bodies, seminaive, compile_rules, plan_joins,
+                                       incremental, materialize_static, backend)
+            static = static_relations(self.initial, self.next, self.always, unstratified, self.fnmapping) if materialize_static else set()
+            mapped = set(fn for item in self.fnmapping.items() for fn in item if isinstance(fn, Relation))
+            self.next, derived = magic_rewrite(self.initial, self.next, self.always, unstratified, static | mapped)
+            self.always = [rule for rule in derived if rule.body is None or all(
+                isinstance(lit, (OracleFormula, NegatedOracleFormula)) for lit in rule.body.as_list())]
+            unstratified = [rule for rule in derived if rule not in self.always]
+        # Create dependency graph, every relation maps to the relations it reads, -1 if negated
+        deps = {}
 
         def make_edge(head, body):
-            if isinstance(head, Formula):
-                deps.add((head.fn, 0, head.fn))
+            edges = deps.setdefault(head.fn, {})
             if isinstance(body, Formula):
-                deps.add((head.fn, 0, body.fn))
+                edges.setdefault(body.fn, 0)
+                deps.setdefault(body.fn, {})
             elif isinstance(body, NegatedFormula):
-                deps.add((head.fn, -1, body.orig.fn))
+                edges[body.orig.fn] = -1
+                deps.setdefault(body.orig.fn, {})
             else:
                 pass
 
         for rule in unstratified:
             assert rule.body is not None
+            deps.setdefault(rule.head.fn, {})
             if isinstance(rule.body, (Formula, NegatedFormula)):
                 make_edge(rule.head, rule.body)
             elif isinstance(rule.body, Conjunction):
@@ -527,93 +1560,993 @@ class Program():
             else:
                 raise ValueError("Unsupported Rule configuration", rule)
 
-        # calculate reachability
-        import itertools
-        rels = set(f for f, val, t in deps) | set(t for f, val, t in deps)
-        edeps = set()
-        for r in rels:
-          reachable = {r: 0}
-          while True:
-            traversal = (len(reachable), sum(reachable.values()))
-            for df, v, dt in deps:
-              if df in reachable:
-                reachable[dt] = min(v, reachable.get(dt, 0), reachable.get(df, 0))
-            if traversal == (len(reachable), sum(reachable.values())):
-              break
-          for reach in reachable:
-            edeps.add((r, reachable[reach] ,reach))
-        deps = edeps
-
-        # calculate a stratification
-        strata = []
-        while deps:  # Algorithm according to Ceri/Gottlob/Tanca 1990
-            this_stratum = set(f for f, val, t in deps)
-            for f, val, t in deps:
-                if val == -1:
-                    this_stratum.discard(f)
-            strata.append(this_stratum)
-            old_deps, deps = deps, set()
-            while old_deps:
-                f, val, t = old_deps.pop()
-                if f in this_stratum or t in this_stratum:
-                    continue
-                deps.add((f, val, t))
+        # calculate a stratification, a relation goes into the stratum given by the most negations
+        # on a dependency path starting at it, as the Ceri/Gottlob/Tanca 1990 algorithm would place it
+        levels = stratum_levels(deps)
 
         # select rules into strata
-        self.strata = []
-        for stratum in strata:
-            this_stratum = []
-            for rule in unstratified:
-                if rule.head.fn in stratum:
-                    this_stratum.append(rule)
-            self.strata.append(this_stratum)
+        self.strata = [[] for _ in range(max(levels.values()) + 1)] if levels else []
+        for rule in unstratified:
+            self.strata[levels[rule.head.fn]].append(rule)
         assert sum(len(s) for s in self.strata) == len(
             unstratified)  # we did not forget a rule
 
-    def run(self, cycles=None, fnmapping=None):
-        for iofacts in self.run_generator(cycles, fnmapping):
+        self.static = set()
+        if materialize_static:
+            self.static = static_relations(self.initial, self.next, self.always, unstratified, self.fnmapping)
+
+        # the strata each stratum reads, strata not ordered by it can be evaluated concurrently
+        self.strata_dag = self.stratum_dag(self.strata, self.fnmapping)
+
+        self.memos = {}
+        for rule in self.next:
+            if isinstance(rule.head, CallFormula) and rule.head.memo is not None:
+                self.memos[rule.head.fn] = rule.head.memo
+
+        # dense frame slots for the variables of every rule, used when a rule is interpreted
+        self.slots = {rule: rule_slots(rule) for rule in self.always + self.next + unstratified if rule.body is not None}
+
+        self.compiled = {}  # filled on first use, for the join orders the planner picks
+        self.frames = {}
+        self.injected = queue.SimpleQueue()
+
+    def __getstate__(self):
+        # facts waiting to be injected belong to the running program
+        state = dict(self.__dict__)
+        del state["injected"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.injected = queue.SimpleQueue()
+
+    def inject(self, *facts):
+        # ground facts merged into the seed of the next cycle of a running program, facts of one
+        # inject always arrive in the same cycle; safe to call from any thread
+        for fact in facts:
+            if not isinstance(fact, Formula):
+                raise ValueError("Only facts of relations can be injected", fact)
+            if any(isinstance(arg, Variable) or arg is Ellipsis for arg in fact.args):
+                raise ValueError("Injected facts must be ground", fact)
+            if fact.fn in self.static:
+                raise ValueError("Cannot inject facts of a time invariant relation", fact)
+        self.injected.put(facts)
+
+    def injected_facts(self, fnmapping):
+        facts = set()
+        while True:
+            try:
+                batch = self.injected.get_nowait()
+            except queue.Empty:
+                return facts
+            facts.update(formula_to_fact(fact, fnmapping) for fact in batch)
+
+    def save(self, path):
+        # persists the analyzed program: oracles and calls are saved by importable name, anything else
+        # has to be passed through fnmapping by key
+        import io
+        buffer = io.BytesIO()
+        try:
+            ProgramPickler(buffer).dump(self)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ValueError("Program cannot be saved, refer to unimportable functions through fnmapping", e)
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, path, relations=()):
+        # a saved program without analysing it again, relations are the caller's Relation objects
+        # for the saved relations of the same name, the others are created
+        with open(path, "rb") as f:
+            program = ProgramUnpickler(f, relations).load()
+        if not isinstance(program, cls):
+            raise ValueError("Not a saved Program", path)
+        return program
+
+    def run(self, cycles=None, fnmapping=None, call_executor=None, rule_executor=None, strata_executor=None, profiler=None):
+        for iofacts in self.run_generator(cycles, fnmapping, call_executor=call_executor, rule_executor=rule_executor,
+                                          strata_executor=strata_executor, profiler=profiler):
             pass
 
-    def run_cb(self, cycles=None, cb=None, fnmapping=None, extended_state=False):
-        for iofacts in self.run_generator(cycles, fnmapping, extended_state):
+    def run_cb(self, cycles=None, cb=None, fnmapping=None, extended_state=False, call_executor=None, rule_executor=None,
+               strata_executor=None, profiler=None, delta=False):
+        for iofacts in self.run_generator(cycles, fnmapping, extended_state, call_executor=call_executor, rule_executor=rule_executor,
+                                          strata_executor=strata_executor, profiler=profiler, delta=delta):
             cb(iofacts)
 
-    def run_generator(self, cycles=None, fnmapping=None, extended_state=False):
+    def run_periodic(self, period_s, cycles=None, cb=None, fnmapping=None, extended_state=False, overrun="warn", stats=None,
+                     call_executor=None, rule_executor=None, strata_executor=None, profiler=None, delta=False):
+        # starts a cycle every period_s seconds and returns the CycleStats of the run; when a cycle
+        # overruns its period "warn" warns and starts the schedule again from now, "skip" waits for
+        # the next period and "catch_up" runs the missed cycles back to back
+        import math
+        import warnings
+        if overrun not in ("warn", "skip", "catch_up"):
+            raise ValueError("Unknown overrun policy", overrun)
+        if period_s <= 0:
+            raise ValueError("Period must be positive", period_s)
+        stats = CycleStats(period_s) if stats is None else stats
+        run = self.run_generator(cycles, fnmapping, extended_state, call_executor=call_executor, rule_executor=rule_executor,
+                                 strata_executor=strata_executor, profiler=profiler, delta=delta)
+        scheduled = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now < scheduled:
+                time.sleep(scheduled - now)
+            started = time.monotonic()
+            try:
+                iofacts = next(run)
+            except StopIteration:
+                break
+            if cb is not None:
+                cb(iofacts)
+            finished = time.monotonic()
+            stats.record(scheduled, started, finished)
+            scheduled += period_s
+            if finished > scheduled:
+                if overrun == "warn":
+                    warnings.warn("Cycle {} overran its period by {:.6f}s".format(stats.cycles, finished - scheduled), RuntimeWarning)
+                    scheduled = finished
+                elif overrun == "skip":
+                    missed = math.ceil((finished - scheduled) / period_s)
+                    stats.skipped += missed
+                    scheduled += missed * period_s
+        return stats
+
+    def run_generator(self, cycles=None, fnmapping=None, extended_state=False, call_executor=None, rule_executor=None,
+                      strata_executor=None, profiler=None, delta=False):
+        # call_executor: a concurrent.futures.Executor running the calls of a cycle concurrently
+        # rule_executor: a thread based Executor evaluating the rules of a stratum round concurrently
+        # strata_executor: a thread based Executor evaluating strata as soon as the strata they read are done,
+        # it must not be the rule_executor since its tasks wait for rule tasks
+        # profiler: a Profiler recording rule, stratum and call timings
+        # delta: yield a StateDelta of the facts added and removed since the previous cycle's output
+        # and a read only view of the output instead of a copy of it; the state is still rebuilt
+        # and compared every cycle, only incremental runs with extended_state reuse their seed changes
+        run = self.cycle_steps(cycles, fnmapping, extended_state, rule_executor, strata_executor, profiler, delta)
+        for calls in run:
+            yield run.send(invoke_calls(calls, call_executor, profiler))
+
+    async def run_async(self, cycles=None, fnmapping=None, extended_state=False, rule_executor=None, strata_executor=None,
+                        profiler=None, delta=False):
+        # like run_generator, but calls may be coroutine functions and all calls of a cycle are awaited together
+        run = self.cycle_steps(cycles, fnmapping, extended_state, rule_executor, strata_executor, profiler, delta)
+        for calls in run:
+            yield run.send(await invoke_calls_async(calls, profiler))
+
+    def cycle_steps(self, cycles, fnmapping, extended_state, rule_executor=None, strata_executor=None, profiler=None, delta=False):
+        # yields the calls of every cycle, is sent their return values and then yields the cycle's output
+        if self.unrewritten is not None and fnmapping and any(
+                self.fnmapping.get(fn) is not target for fn, target in fnmapping.items()
+                if isinstance(fn, Relation) or isinstance(target, Relation)):
+            self.unrewritten.injected = self.injected
+            return (yield from self.unrewritten.cycle_steps(cycles, fnmapping, extended_state, rule_executor,
+                                                            strata_executor, profiler, delta))
         fnmapping = {} if fnmapping is None else fnmapping
         fnmapping = {**self.fnmapping, **fnmapping}
-
-        initial_facts = initial_facts_to_model(self.initial)
-        model = initial_facts
+        memos = {fnmapping.get(fn, fn): memo for fn, memo in self.memos.items()}
+
+        rule_fns = {}  # compiled or frame interpreted rules bound to the fnmapping of this run
+        # time invariant relations are derived once per run and shared by all cycles,
+        # aliases added by the fnmapping of the run can make some of them dynamic
+        static_fns = self.static
+        if static_fns and any(self.fnmapping.get(fn) is not target for fn, target in fnmapping.items()):
+            static_fns = static_fns & static_relations(self.initial, self.next, self.always,
+                                                       [rule for stratum in self.strata for rule in stratum], fnmapping)
+        static = Model()
+        for stratum in [self.always] + self.strata:
+            self.fixpoint([rule for rule in stratum if rule.head.fn in static_fns], static, fnmapping, rule_fns, rule_executor, profiler)
+        strata = [[rule for rule in stratum if rule.head.fn not in static_fns] for stratum in [self.always] + self.strata]
+        dag = self.stratum_dag(strata, fnmapping)
+        initial_facts = initial_facts_to_model(self.initial) | self.injected_facts(fnmapping)
+        model = Model(initial_facts, base=static)
+        seed = initial_facts
+        output = frozenset()
+        tentative_next_model = None
+        seed_added = seed_removed = frozenset()
         while True:
             if cycles == 0:
                 break
-            for stratum in [self.always] + self.strata:
-                while True:
-                    new_facts = apply_rules(stratum, model, fnmapping)
-                    if not new_facts - model:
-                        break
-                    model = model | new_facts
-            tentative_next_model = apply_rules(self.next, model, fnmapping)
+            if not self.incremental or tentative_next_model is None:
+                if strata_executor is None:
+                    for n, stratum in enumerate(strata):
+                        self.fixpoint(stratum, model, fnmapping, rule_fns, rule_executor, profiler, stratum_name(n))
+                else:
+                    self.concurrent_fixpoint(strata, dag, model, fnmapping, rule_fns, strata_executor, rule_executor, profiler)
+                tentative_next_model = self.apply(self.next, model, fnmapping, rule_fns, executor=rule_executor, profiler=profiler)
+                if self.incremental:
+                    tentative_next_model = Model(tentative_next_model)
+            else:
+                self.maintain(strata, model, seed, seed_added, seed_removed, tentative_next_model, fnmapping, rule_fns, profiler)
             next_model = set()
-            iofacts = set()
+            calls = []
             for fact_head, fact_args in tentative_next_model:
                 if isinstance(fact_head, Relation):
                     next_model.add((fact_head, fact_args))
                 elif callable(fact_head):
-                    return_value = fact_head(*fact_args)
-                    if isinstance(return_value, tuple):
-                        iofact = (fact_head, fact_args + return_value)
+                    calls.append((fact_head, fact_args))
+            iofacts = set()
+            if memos:
+                uncached = []
+                for fact_head, fact_args in calls:
+                    memo = memos.get(fact_head)
+                    hit, return_value = (False, None) if memo is None else memo.get(fact_head, fact_args)
+                    if hit:
+                        iofacts.add(call_result_fact(fact_head, fact_args, return_value))
                     else:
-                        iofact = (fact_head, fact_args + (return_value,))
-                    iofacts.add(iofact)
-            model = next_model | iofacts
-            if extended_state:
-                yield frozenset(model)
+                        uncached.append((fact_head, fact_args))
+                calls = uncached
+            results = yield calls
+            for (fact_head, fact_args), return_value in zip(calls, results):
+                if fact_head in memos:
+                    memos[fact_head].put(fact_head, fact_args, return_value)
+                iofacts.add(call_result_fact(fact_head, fact_args, return_value))
+            for memo in memos.values():
+                memo.tick()
+            next_seed = next_model | iofacts | self.injected_facts(fnmapping)
+            if self.incremental:
+                # the model is kept and maintained with the changed seed in the next cycle
+                seed_added = next_seed - seed
+                seed_removed = seed - next_seed
+            else:
+                model = Model(next_seed, base=static)
+            previous_seed, seed = seed, next_seed
+            if profiler is not None:
+                profiler.end_cycle()
+            if delta:
+                # seed and iofacts are fresh sets every cycle, so the view needs no copy; the
+                # differences take a pass over the state, unless the seed changes an incremental
+                # run computed for maintenance are already the changes of the output
+                previous, output = output, seed if extended_state else iofacts
+                if self.incremental and previous is previous_seed:
+                    added, removed = seed_added, seed_removed
+                else:
+                    added, removed = output - previous, previous - output
+                yield StateDelta(frozenset(added), frozenset(removed), StateView(output))
+            elif extended_state:
+                yield frozenset(seed)
             else:
                 yield frozenset(iofacts)
             if cycles is not None:
                 cycles = cycles - 1
 
+    def maintain(self, strata, model, seed, seed_added, seed_removed, tentative, fnmapping, rule_fns, profiler=None):
+        # DRed across cycles: overdelete everything derived with a removed fact, rederive what
+        # is still supported, then insert semi-naively from what was added
+        added = Model()
+        removed = Model()
+        # the rules of a relation can be spread over the always stratum and the one it is placed in
+        defining = {}
+        for stratum in strata:
+            for rule in stratum:
+                defining.setdefault(fnmapping[rule.head.fn] if rule.head.fn in fnmapping else rule.head.fn, []).append(rule)
+        derived = set(defining)
+        pending = Model()
+        for fact in seed_removed:
+            if fact[0] in derived:
+                pending.add(fact)  # may still be derivable, decided in its stratum
+            elif model.discard(fact):
+                removed.add(fact)
+        for fact in seed_added:
+            if model.add(fact):
+                added.add(fact)
+        for n, stratum in enumerate(strata):
+            start = time.perf_counter()
+            iterations = 2
+            heads = set(fnmapping[rule.head.fn] if rule.head.fn in fnmapping else rule.head.fn for rule in stratum)
+            deleted = Model(fact for fact in pending if fact[0] in heads and fact in model)
+            old = ModelUnion(model, removed)
+            fresh = self.propagate(stratum, "delete", old, ModelUnion(removed, deleted), added, fnmapping, rule_fns, profiler)
+            while True:
+                fresh = Model(fact for fact in fresh if fact in model and fact not in deleted)
+                if not fresh:
+                    break
+                deleted.update(fresh)
+                iterations += 1
+                fresh = self.propagate(stratum, "delete", old, fresh, None, fnmapping, rule_fns, profiler)
+            for fact in deleted:
+                model.discard(fact)
+            rederived = Model(fact for fact in deleted if fact in seed or self.derivable(fact, defining[fact[0]], model, fnmapping))
+            model.update(rederived)
+            inserted = Model()
+            fresh = self.propagate(stratum, "insert", model, ModelUnion(added, rederived), removed, fnmapping, rule_fns, profiler)
+            while True:
+                fresh = Model(fact for fact in fresh if fact not in model)
+                if not fresh:
+                    break
+                model.update(fresh)
+                inserted.update(fresh)
+                iterations += 1
+                fresh = self.propagate(stratum, "insert", model, fresh, None, fnmapping, rule_fns, profiler)
+            removed.update(fact for fact in deleted if fact not in model)
+            added.update(fact for fact in inserted if fact not in deleted)
+            if profiler is not None:
+                profiler.stratum(stratum_name(n), iterations, time.perf_counter() - start)
+        # the rules for the next cycle do not feed back, so one round each suffices
+        dead = [fact for fact in self.propagate(self.next, "delete", ModelUnion(model, removed), removed, added, fnmapping, rule_fns, profiler) if fact in tentative]
+        for fact in dead:
+            tentative.discard(fact)
+        tentative.update(fact for fact in dead if self.derivable(fact, self.next, model, fnmapping))
+        tentative.update(self.propagate(self.next, "insert", model, added, removed, fnmapping, rule_fns, profiler))
+
+    def variants(self, rule, kind):
+        # the rule once per body literal, reading that literal (as positive literal) first from a delta;
+        # for deletions the other negations are left out, which can only overestimate
+        key = (rule, kind)
+        if key not in self.maintenance:
+            literals = [] if rule.body is None else rule.body.as_list()
+            variants = []
+            for n, lit in enumerate(literals):
+                if isinstance(lit, (Formula, CallFormula)):
+                    delta_lit = lit
+                elif isinstance(lit, (NegatedFormula, NegatedCallFormula)):
+                    delta_lit = lit.orig
+                else:
+                    continue
+                others = [other for m, other in enumerate(literals) if m != n and (
+                    kind == "insert" or not isinstance(other, (NegatedFormula, NegatedCallFormula)))]
+                if kind == "insert" and delta_lit is not lit:
+                    others.append(lit)  # the negation has to hold in the new model
+                variants.append((delta_lit, delta_lit is not lit, Rule(rule.head, Conjunction(delta_lit, *others))))
+            self.maintenance[key] = variants
+        return self.maintenance[key]
+
+    def propagate(self, rules, kind, model, positive, negative, fnmapping, rule_fns, profiler=None):
+        # heads derivable using a positive delta fact for a positive literal or a negative one for a negation
+        new_facts = set()
+        for rule in rules:
+            for delta_lit, negated, variant in self.variants(rule, kind):
+                delta = negative if negated else positive
+                if delta is None or not any(delta.count(rel) for rel in literal_relations(delta_lit, fnmapping)):
+                    continue
+                sources = [delta] + [None] * (len(variant.body.as_list()) - 1)
+                self.evaluate(variant, model, fnmapping, rule_fns, new_facts, sources, profiler, rule)
+        return new_facts
+
+    def derivable(self, fact, rules, model, fnmapping):
+        rel, args = fact
+        for rule in rules:
+            if (fnmapping[rule.head.fn] if rule.head.fn in fnmapping else rule.head.fn) != rel:
+                continue
+            substitution = match_head(rule.head, args)
+            if substitution is None:
+                continue
+            if rule.body is None:
+                return True
+            body = Conjunction(*[lit.apply_substitution(substitution) for lit in rule.body.as_list()]).reorder()
+            for _ in body.substitutions(model, fnmapping=fnmapping):
+                return True
+        return False
+
+    def compile(self, rule, order):
+        key = (rule, order)
+        if key not in self.compiled:
+            literals = rule.body.as_list()
+            try:
+                self.compiled[key] = CompiledRule(Rule(rule.head, Conjunction(*[literals[n] for n in order])))
+            except ValueError:
+                self.compiled[key] = None  # stays interpreted
+        return self.compiled[key]
+
+    def frame(self, rule, order):
+        key = (rule, order)
+        if key not in self.frames:
+            literals = rule.body.as_list()
+            slots = self.slots.get(rule)
+            if slots is None:
+                slots = rule_slots(rule)  # a variant made for maintenance
+            self.frames[key] = FrameRule(Rule(rule.head, Conjunction(*[literals[n] for n in order])), slots)
+        return self.frames[key]
+
+    def vectorize(self, rule, order):
+        key = (rule, order)
+        if key not in self.vectorized:
+            literals = rule.body.as_list()
+            try:
+                self.vectorized[key] = VectorizedRule(Rule(rule.head, Conjunction(*[literals[n] for n in order])))
+            except ValueError:
+                self.vectorized[key] = None  # stays on the Python path
+        return self.vectorized[key]
+
+    def plan(self, rule, model, fnmapping, sources=None):
+        # a plan is kept until the size of a relation it joins has changed by more than PLAN_DRIFT,
+        # bodies with at most one relation literal have a single possible plan
+        key = (rule, None if sources is None else tuple(source is not None for source in sources))
+        planned = self.planned.get(key)
+        literals = rule.body.as_list()
+        positives = [n for n, lit in enumerate(literals) if isinstance(lit, (Formula, CallFormula))]
+        if not self.plan_joins or len(positives) < 2:
+            if planned is None:
+                order = tuple(range(len(literals)))
+                if self.plan_joins and isinstance(rule.body, Conjunction):
+                    order = tuple(rule.body.plan(lambda n, bound: 0))
+                planned = self.planned[key] = (order, None)
+                self.plans[rule] = order
+            return planned[0]
+        sizes = tuple(sum((model if sources is None or sources[n] is None else sources[n]).count(rel)
+                          for rel in literal_relations(literals[n], fnmapping)) for n in positives)
+        if planned is not None and not any(
+                max(old, new) + 1 > PLAN_DRIFT * (min(old, new) + 1) for old, new in zip(planned[1], sizes)):
+            return planned[0]
+        order = self.join_order(rule, model, fnmapping, sources)
+        self.planned[key] = (order, sizes)
+        self.plans[rule] = order
+        return order
+
+    def join_order(self, rule, model, fnmapping, sources=None):
+        literals = rule.body.as_list()
+
+        def estimate(n, bound):
+            data = model if sources is None or sources[n] is None else sources[n]
+            return estimate_matches(literals[n], bound, data, fnmapping)
+        return tuple(rule.body.plan(estimate)) if isinstance(rule.body, Conjunction) else (0,)
+
+    def explain(self, model=None, fnmapping=None):
+        # the join order of every rule, planned against model or as last used
+        fnmapping = {**self.fnmapping, **({} if fnmapping is None else fnmapping)}
+        if model is not None and not isinstance(model, Model):
+            model = Model(model)
+        lines = []
+        for name, rules in [("always", self.always)] + [("stratum {}".format(n), s) for n, s in enumerate(self.strata)] + [("next", self.next)]:
+            lines.append("{}:".format(name))
+            for rule in rules:
+                if rule.body is None:
+                    lines.append("  {}".format(repr(rule)))
+                    continue
+                literals = rule.body.as_list()
+                if model is not None:
+                    order = self.join_order(rule, model, fnmapping) if self.plan_joins else tuple(range(len(literals)))
+                else:
+                    order = self.plans.get(rule, tuple(range(len(literals))))
+                steps = []
+                bound = set()
+                for n in order:
+                    lit = literals[n]
+                    if model is not None and isinstance(lit, (Formula, CallFormula)):
+                        steps.append("{} [~{:g}]".format(repr(lit), estimate_matches(lit, bound, model, fnmapping)))
+                        bound.update(var.varname for var in lit.variables())
+                    else:
+                        steps.append(repr(lit))
+                lines.append("  {} <- {}.".format(repr(rule.head), " & ".join(steps)))
+        return "\n".join(lines)
+
+    def evaluate(self, rule, model, fnmapping, rule_fns, out, sources=None, profiler=None, origin=None):
+        # origin: the program rule that rule was derived from, for the profiler
+        if profiler is not None:
+            return profiler.evaluate(self, rule if origin is None else origin, rule, model, fnmapping, rule_fns, out, sources)
+        if rule.body is None:
+            out.add(formula_to_fact(rule.head, fnmapping=fnmapping))
+            return 1
+        order = self.plan(rule, model, fnmapping, sources)
+        ordered_sources = None if sources is None else [sources[n] for n in order]
+        if self.backend == "numpy":
+            vectorized = self.vectorize(rule, order)
+            n = None if vectorized is None else vectorized.evaluate(model, out, ordered_sources, fnmapping)
+            if n is not None:
+                return n
+        rule_fn = None if rule_fns is None else rule_fns.get((rule, order))
+        if rule_fn is None:
+            executable = self.compile(rule, order) if self.compile_rules else None
+            if executable is None:
+                executable = self.frame(rule, order)
+            rule_fn = executable.bind(fnmapping)
+            if rule_fns is not None:
+                rule_fns[(rule, order)] = rule_fn
+        return rule_fn(model, out, ordered_sources)
+
+    def apply(self, rules, model, fnmapping, rule_fns, delta=None, recursive=None, executor=None, profiler=None):
+        new_facts = set()
+        if executor is None:
+            for rule in rules:
+                if delta is None:
+                    self.evaluate(rule, model, fnmapping, rule_fns, new_facts, profiler=profiler)
+                    continue
+                for sources in delta_sources(rule, delta, recursive, fnmapping):
+                    self.evaluate(rule, model, fnmapping, rule_fns, new_facts, sources, profiler)
+            return new_facts
+        # all rules read the same model, each task derives into its own set and they are merged in task order
+        tasks = []
+        for rule in rules:
+            for sources in ([None] if delta is None else delta_sources(rule, delta, recursive, fnmapping)):
+                tasks.extend(self.partition(rule, model, fnmapping, sources))
+
+        def derive(rule, sources):
+            out = set()
+            self.evaluate(rule, model, fnmapping, rule_fns, out, sources, profiler)
+            return out
+
+        for future in [executor.submit(derive, rule, sources) for rule, sources in tasks]:
+            new_facts.update(future.result())
+        return new_facts
+
+    def partition(self, rule, model, fnmapping, sources):
+        # (rule, sources) tasks splitting the facts of the first relation literal of a large rule
+        import os
+        parts = os.cpu_count() or 1
+        if rule.body is None or parts < 2:
+            return [(rule, sources)]
+        literals = rule.body.as_list()
+        first = next((n for n in self.plan(rule, model, fnmapping, sources) if isinstance(literals[n], (Formula, CallFormula))), None)
+        if first is None:
+            return [(rule, sources)]
+        data = model if sources is None or sources[first] is None else sources[first]
+        facts = [(rel, args) for rel in literal_relations(literals[first], fnmapping) for args in data.facts(rel)]
+        if len(facts) < PARTITION_MIN_FACTS:
+            return [(rule, sources)]
+        tasks = []
+        size = -(-len(facts) // parts)
+        for start in range(0, len(facts), size):
+            part = [None] * len(literals) if sources is None else list(sources)
+            part[first] = Model(facts[start:start + size])
+            tasks.append((rule, part))
+        return tasks
+
+    def stratum_dag(self, strata, fnmapping):
+        # for every stratum the earlier strata it has to wait for, as in the linear order: those
+        # writing a relation it reads, and those reading a relation it writes, which must not see
+        # its facts yet; a relation can be written by more than one stratum, e.g. by always facts
+        # and by derived rules, and with fnmapping aliases also by a later stratum
+        writers = {}
+        for n, stratum in enumerate(strata):
+            for rule in stratum:
+                writers.setdefault(fnmapping.get(rule.head.fn, rule.head.fn), set()).add(n)
+        dag = [set() for _ in strata]
+        for n, stratum in enumerate(strata):
+            for rule in stratum:
+                for lit in ([] if rule.body is None else rule.body.as_list()):
+                    lit = lit.orig if isinstance(lit, NegatedFormula) else lit
+                    if isinstance(lit, Formula):
+                        for m in writers.get(fnmapping.get(lit.fn, lit.fn), ()):
+                            if m < n:
+                                dag[n].add(m)
+                            elif m > n:
+                                dag[m].add(n)
+        return dag
+
+    def concurrent_fixpoint(self, strata, dag, model, fnmapping, rule_fns, executor, rule_executor=None, profiler=None):
+        # every stratum is evaluated into a layer over model once the strata it reads are merged,
+        # the layers of strata writing the same relation are unions, so they are merged as they finish
+        import concurrent.futures
+        pending = dict(enumerate(strata))
+        running = {}
+        done = set()
+        while pending or running:
+            ready = [n for n in pending if dag[n] <= done]
+            if not ready and not running:
+                ready = [min(pending)]  # all strata before it are merged, as in the linear order
+            for n in ready:
+                layer = Model(base=model)
+                running[executor.submit(self.fixpoint, pending.pop(n), layer, fnmapping, rule_fns, rule_executor, profiler, stratum_name(n))] = (n, layer)
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                n, layer = running.pop(future)
+                future.result()
+                model.update((rel, args) for rel, partition in layer.partitions.items() for args in partition)
+                done.add(n)
+
+    def fixpoint(self, stratum, model, fnmapping, rule_fns=None, executor=None, profiler=None, name=None):
+        # returns the number of rounds, recorded for the stratum name if there is a profiler
+        start = time.perf_counter()
+        iterations = 1
+        new_facts = self.apply(stratum, model, fnmapping, rule_fns, executor=executor, profiler=profiler)
+        if not self.seminaive:
+            while model.update(new_facts):
+                iterations += 1
+                new_facts = self.apply(stratum, model, fnmapping, rule_fns, executor=executor, profiler=profiler)
+        else:
+            # semi-naive: after the first round only join against the facts derived last round
+            recursive = set(fnmapping.get(rule.head.fn, rule.head.fn) for rule in stratum)
+            while True:
+                delta = Model(fact for fact in new_facts if fact not in model)
+                if not delta:
+                    break
+                model.update(delta)
+                iterations += 1
+                new_facts = self.apply(stratum, model, fnmapping, rule_fns, delta=delta, recursive=recursive, executor=executor, profiler=profiler)
+        if profiler is not None and name is not None:
+            profiler.stratum(name, iterations, time.perf_counter() - start)
+        return iterations
+
+class StateView():
+    # read only access to the facts output by a cycle
+    facts = None
+
+    def __init__(self, facts):
+        self.facts = facts
+
+    def __contains__(self, fact):
+        return fact in self.facts
+
+    def __iter__(self):
+        return iter(self.facts)
+
+    def __len__(self):
+        return len(self.facts)
+
+    def __repr__(self):
+        return "StateView({})".format(repr(self.facts))
+
+class CycleStats():
+    # timing of periodic cycles: latencies in a histogram with bounds relative to the period,
+    # start jitter against the schedule and deadline misses
+    BOUNDS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0, 1.5, 2.0)
+    period_s = None
+    cycles = 0
+    deadline_misses = 0
+    skipped = 0
+    histogram = None
+    latency_total = 0.0
+    latency_max = 0.0
+    lateness_mean = 0.0
+    lateness_m2 = 0.0
+    lateness_max = 0.0
+
+    def __init__(self, period_s):
+        self.period_s = period_s
+        self.histogram = [0] * (len(self.BOUNDS) + 1)
+
+    def record(self, scheduled, started, finished):
+        latency = finished - started
+        lateness = started - scheduled
+        self.cycles += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.histogram[next((n for n, bound in enumerate(self.BOUNDS) if latency <= bound * self.period_s), len(self.BOUNDS))] += 1
+        if finished > scheduled + self.period_s:
+            self.deadline_misses += 1
+        # running mean and variance of the start lateness (Welford)
+        delta = lateness - self.lateness_mean
+        self.lateness_mean += delta / self.cycles
+        self.lateness_m2 += delta * (lateness - self.lateness_mean)
+        self.lateness_max = max(self.lateness_max, lateness)
+
+    def report(self):
+        return {
+            "period_s": self.period_s,
+            "cycles": self.cycles,
+            "deadline_misses": self.deadline_misses,
+            "skipped_periods": self.skipped,
+            "latency_mean_s": self.latency_total / self.cycles if self.cycles else 0.0,
+            "latency_max_s": self.latency_max,
+            "latency_histogram": [(bound * self.period_s, count) for bound, count in zip(self.BOUNDS + (float("inf"),), self.histogram)],
+            "jitter_s": (self.lateness_m2 / self.cycles) ** 0.5 if self.cycles else 0.0,
+            "lateness_mean_s": self.lateness_mean,
+            "lateness_max_s": self.lateness_max,
+        }
+
+def stratum_name(n):
+    # for strata lists starting with the always rules, as in Program.explain
+    return "always" if n == 0 else "stratum {}".format(n - 1)
+
+class ProfileStats():
+    rules = None  # rule: [evaluations, seconds, substitutions, new facts]
+    strata = None  # name: [runs, seconds, iterations]
+    calls = None  # fn: [invocations, seconds, max seconds]
+
+    def __init__(self):
+        self.rules = {}
+        self.strata = {}
+        self.calls = {}
+
+    def merge(self, other):
+        for rule, (evaluations, seconds, substitutions, new_facts) in other.rules.items():
+            stats = self.rules.setdefault(rule, [0, 0.0, 0, 0])
+            stats[0] += evaluations
+            stats[1] += seconds
+            stats[2] += substitutions
+            stats[3] += new_facts
+        for name, (runs, seconds, iterations) in other.strata.items():
+            stats = self.strata.setdefault(name, [0, 0.0, 0])
+            stats[0] += runs
+            stats[1] += seconds
+            stats[2] += iterations
+        for fn, (invocations, seconds, longest) in other.calls.items():
+            stats = self.calls.setdefault(fn, [0, 0.0, 0.0])
+            stats[0] += invocations
+            stats[1] += seconds
+            stats[2] = max(stats[2], longest)
+
+    def report(self):
+        # plain data, rules and calls by descending time
+        return {
+            "rules": [{"rule": repr(rule), "evaluations": evaluations, "seconds": seconds, "substitutions": substitutions,
+                       "new_facts": new_facts}
+                      for rule, (evaluations, seconds, substitutions, new_facts) in sorted(self.rules.items(), key=lambda item: -item[1][1])],
+            "strata": [{"stratum": name, "runs": runs, "seconds": seconds, "iterations": iterations}
+                       for name, (runs, seconds, iterations) in self.strata.items()],
+            "calls": [{"call": getattr(fn, "__qualname__", repr(fn)), "invocations": invocations, "seconds": seconds, "max_seconds": longest}
+                      for fn, (invocations, seconds, longest) in sorted(self.calls.items(), key=lambda item: -item[1][1])],
+        }
+
+class Profiler():
+    # pass to run_generator/run_cb/run_async; on_cycle is called with the report of every finished cycle
+    on_cycle = None
+    cycles = 0
+    totals = None
+    current = None
+    lock = None
+
+    def __init__(self, on_cycle=None):
+        import threading
+        self.on_cycle = on_cycle
+        self.totals = ProfileStats()
+        self.current = ProfileStats()
+        self.lock = threading.Lock()
+
+    def evaluate(self, program, origin, rule, model, fnmapping, rule_fns, out, sources):
+        derived = set()
+        start = time.perf_counter()
+        n = program.evaluate(rule, model, fnmapping, rule_fns, derived, sources)
+        seconds = time.perf_counter() - start
+        new_facts = sum(1 for fact in derived if fact not in model and fact not in out)
+        out.update(derived)
+        with self.lock:
+            stats = self.current.rules.setdefault(origin, [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += n
+            stats[3] += new_facts
+        return n
+
+    def stratum(self, name, iterations, seconds):
+        with self.lock:
+            stats = self.current.strata.setdefault(name, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += iterations
+
+    def call(self, fn, seconds):
+        with self.lock:
+            stats = self.current.calls.setdefault(fn, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def end_cycle(self):
+        with self.lock:
+            self.cycles += 1
+            cycle = {"cycle": self.cycles, **self.current.report()}
+            self.totals.merge(self.current)
+            self.current = ProfileStats()
+        if self.on_cycle is not None:
+            self.on_cycle(cycle)
+
+    def report(self):
+        # everything recorded so far, including an unfinished cycle
+        with self.lock:
+            stats = ProfileStats()
+            stats.merge(self.totals)
+            stats.merge(self.current)
+            return {"cycles": self.cycles, **stats.report()}
+
+class ProgramPickler(pickle.Pickler):
+    relations = None
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.relations = {}
+
+    def persistent_id(self, obj):
+        # relations are identified by name
+        if not isinstance(obj, Relation):
+            return None
+        if self.relations.setdefault(obj.relname, obj) is not obj:
+            raise ValueError("Two relations with the same name", obj.relname)
+        return ("relation", obj.relname)
+
+class ProgramUnpickler(pickle.Unpickler):
+    relations = None
+
+    def __init__(self, file, relations=()):
+        super().__init__(file)
+        self.relations = {rel.relname: rel for rel in relations}
+
+    def persistent_load(self, pid):
+        kind, relname = pid
+        if kind != "relation":
+            raise pickle.UnpicklingError("Unknown persistent id", pid)
+        if relname not in self.relations:
+            self.relations[relname] = Relation(relname)
+        return self.relations[relname]
+
+def call_result_fact(fact_head, fact_args, return_value):
+    if isinstance(return_value, tuple):
+        return (fact_head, fact_args + return_value)
+    return (fact_head, fact_args + (return_value,))
+
+def invoke_call(fact_head, fact_args, profiler=None):
+    if profiler is None:
+        return fact_head(*fact_args)
+    start = time.perf_counter()
+    try:
+        return fact_head(*fact_args)
+    finally:
+        profiler.call(fact_head, time.perf_counter() - start)
+
+def invoke_calls(calls, executor=None, profiler=None):
+    if executor is None:
+        results = [invoke_call(fact_head, fact_args, profiler) for fact_head, fact_args in calls]
+    else:
+        # all calls of a cycle are independent, their results are only seen in the next cycle
+        futures = [executor.submit(invoke_call, fact_head, fact_args, profiler) for fact_head, fact_args in calls]
+        results = [future.result() for future in futures]
+    return results
+
+async def invoke_calls_async(calls, profiler=None):
+    import asyncio
+    import inspect
+
+    async def invoke(fact_head, fact_args):
+        start = time.perf_counter()
+        return_value = fact_head(*fact_args)
+        if inspect.isawaitable(return_value):
+            return_value = await return_value
+        if profiler is not None:
+            profiler.call(fact_head, time.perf_counter() - start)
+        return return_value
+
+    return list(await asyncio.gather(*[invoke(fact_head, fact_args) for fact_head, fact_args in calls]))
+
+def static_relations(initial, next_rules, always, unstratified, fnmapping=None):
+    # relations that cannot change between cycles: not seeded by START or NEXT heads
+    # and not depending on those, on call results, on injected facts or on fnmapping aliases,
+    # even transitively
+    dynamic = set(rule.head.fn for rule in initial + next_rules if isinstance(rule.head, TempAnnotatedFormula))
+    defined = set(rule.head.fn for rule in initial + next_rules + always + unstratified)
+    todo = list(dynamic)
+    todo.extend(fn for item in (fnmapping or {}).items() for fn in item if isinstance(fn, Relation))
+    readers = {}
+    for rule in always + unstratified:
+        for lit in ([] if rule.body is None else rule.body.as_list()):
+            if isinstance(lit, (CallFormula, NegatedCallFormula)):
+                todo.append(rule.head.fn)
+            elif isinstance(lit, (Formula, NegatedFormula)):
+                fn = lit.fn if isinstance(lit, Formula) else lit.orig.fn
+                readers.setdefault(fn, []).append(rule.head.fn)
+                if fn not in defined:
+                    todo.append(fn)  # only ever filled by inject
+    while todo:
+        rel = todo.pop()
+        dynamic.add(rel)
+        todo.extend(head for head in readers.pop(rel, ()) if head not in dynamic)
+    return set(rule.head.fn for rule in always + unstratified) - dynamic
+
+def magic_rewrite(initial, next_rules, always, unstratified, keep):
+    # demand transformation: a derived relation gets a copy per pattern of bound arguments it is
+    # read with, guarded by a magic relation holding the bindings the rules reading it can supply,
+    # so only facts reachable from the NEXT rules are derived. Relations in keep, negated ones and
+    # everything those read keep their rules, so no negation cycle can be introduced.
+    # Returns the rewritten NEXT rules and the other rules.
+    derived = always + unstratified
+    rules_of = {}
+    arities = {}
+    reads = {}
+    for rule in initial + next_rules + derived:
+        arities.setdefault(rule.head.fn, set()).add(len(rule.head.args))
+    for rule in derived:
+        rules_of.setdefault(rule.head.fn, []).append(rule)
+    keep = set(keep)
+    for rule in derived + next_rules:
+        for lit in ([] if rule.body is None else rule.body.as_list()):
+            if isinstance(lit, NegatedFormula):
+                keep.add(lit.orig.fn)
+                lit = lit.orig
+            elif not isinstance(lit, Formula):
+                continue
+            elif arities.get(lit.fn, {len(lit.args)}) != {len(lit.args)}:
+                keep.add(lit.fn)  # padded matches are not rewritten
+            reads.setdefault(rule.head.fn, set()).add(lit.fn)
+    todo = list(keep)
+    while todo:
+        for rel in reads.get(todo.pop(), ()):
+            if rel not in keep:
+                keep.add(rel)
+                todo.append(rel)
+    rewritable = set(rule.head.fn for rule in unstratified) - keep
+
+    adorned = {}  # (relation, adornment): (adorned relation, magic relation)
+    pending = []
+
+    def demand(lit, bound):
+        adornment = "".join("b" if arg is not Ellipsis and (not isinstance(arg, Variable) or arg.varname in bound) else "f"
+                            for arg in lit.args)
+        if (lit.fn, adornment) not in adorned:
+            name = "{}/{}".format(lit.fn.relname, adornment)
+            adorned[(lit.fn, adornment)] = (Relation(name), Relation("magic[{}]".format(name)))
+            pending.append((lit.fn, adornment))
+        rel, magic = adorned[(lit.fn, adornment)]
+        return rel, magic(*[arg for arg, a in zip(lit.args, adornment) if a == "b"])
+
+    def rewrite(head, literals, guard):
+        # the rule reading adorned relations and the rules demanding their facts
+        bound = set() if guard is None else set(var.varname for var in guard.variables())
+        body = [] if guard is None else [guard]
+        rules = []
+        for lit in literals:
+            if isinstance(lit, Formula) and lit.fn in rewritable:
+                rel, magic = demand(lit, bound)
+                # filters join the prefix once the variables they test are bound
+                prefix = [other for other in body if isinstance(other, (Formula, CallFormula)) or
+                          all(var.varname in bound for var in other.variables())]
+                rules.append(Rule(magic, Conjunction(*prefix) if len(prefix) > 1 else prefix[0]) if prefix else magic.as_rule())
+                lit = rel(*lit.args)
+            body.append(lit)
+            if isinstance(lit, (Formula, CallFormula)):
+                bound.update(var.varname for var in lit.variables())
+        if not body:
+            return [head.as_rule()] + rules
+        return [Rule(head, Conjunction(*body) if len(body) > 1 else body[0])] + rules
+
+    new_next = []
+    new_derived = [rule for rule in derived if rule.head.fn not in rewritable]
+    for rule in next_rules:
+        rewritten, *demands = rewrite(rule.head, [] if rule.body is None else rule.body.as_list(), None)
+        new_next.append(rewritten)
+        new_derived.extend(demands)
+    while pending:
+        fn, adornment = pending.pop()
+        rel, magic = adorned[(fn, adornment)]
+        for rule in rules_of[fn]:
+            guard = magic(*[arg for arg, a in zip(rule.head.args, adornment) if a == "b"])
+            new_derived.extend(rewrite(rel(*rule.head.args), [] if rule.body is None else rule.body.as_list(), guard))
+        # the facts seeded by START or NEXT rules or injected
+        args = [Variable("V{}".format(n)) for n in range(len(adornment))]
+        guard = magic(*[arg for arg, a in zip(args, adornment) if a == "b"])
+        new_derived.append(Rule(rel(*args), Conjunction(guard, fn(*args))))
+    return new_next, new_derived
+
+def stratum_levels(deps):
+    # the stratum of every relation in deps, computed over its strongly connected components with
+    # Tarjan's algorithm: components are completed after everything they read
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    levels = {}
+    for root in deps:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(deps[root]))]
+        while work:
+            rel, edges = work[-1]
+            for dep in edges:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, iter(deps[dep])))
+                    break
+                if dep in on_stack:
+                    lowlink[rel] = min(lowlink[rel], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[rel])
+                if lowlink[rel] != index[rel]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == rel:
+                        break
+                level = 0
+                for member in component:
+                    for dep, sign in deps[member].items():
+                        if dep not in levels:  # inside the component, the others are done
+                            if sign:
+                                raise ValueError("Program not stratifiable, negation in a recursive cycle", member, dep)
+                        else:
+                            level = max(level, levels[dep] - sign)
+                for member in component:
+                    levels[member] = level
+    return levels
+
 def formula_to_fact(formula, fnmapping=None):
     fnmapping = {} if fnmapping is None else fnmapping
     fn = fnmapping[formula.fn] if formula.fn in fnmapping else formula.fn
@@ -622,17 +2555,59 @@ def formula_to_fact(formula, fnmapping=None):
 def initial_facts_to_model(init):
     return set(formula_to_fact(rule.head) for rule in init)
 
-def apply_rules(rules, model, fnmapping=None):
+def apply_rules(rules, model, fnmapping=None, delta=None, recursive=None):
+    # with a delta, only derivations using a delta fact for a recursive literal are made
     fnmapping = {} if fnmapping is None else fnmapping
+    if not isinstance(model, Model):
+        model = Model(model)
     new_facts = set()
     for rule in rules:
-        if rule.body is None:
-            new_facts.add(formula_to_fact(rule.head, fnmapping=fnmapping))
+        if delta is None:
+            if rule.body is None:
+                new_facts.add(formula_to_fact(rule.head, fnmapping=fnmapping))
+                continue
+            for subst in rule.body.substitutions(model, fnmapping=fnmapping):
+                new_facts.add(formula_to_fact(rule.head.apply_substitution(subst), fnmapping=fnmapping))
             continue
-        for subst in rule.body.substitutions(model, fnmapping=fnmapping):
-            new_facts.add(formula_to_fact(rule.head.apply_substitution(subst), fnmapping=fnmapping))
+        for sources in delta_sources(rule, delta, recursive, fnmapping):
+            for subst in Conjunction(*rule.body.as_list()).substitutions(model, fnmapping=fnmapping, sources=sources):
+                new_facts.add(formula_to_fact(rule.head.apply_substitution(subst), fnmapping=fnmapping))
     return new_facts
 
+PLAN_DRIFT = 2  # factor a relation size may grow or shrink by before a rule is planned again
+SELECTIVITY = 0.1  # assumed fraction of facts agreeing on a bound argument without an index
+
+def literal_relations(lit, fnmapping):
+    # the model relations a positive literal reads
+    fn = fnmapping[lit.fn] if isinstance(lit, CallFormula) and lit.fn in fnmapping else lit.fn
+    return relation_aliases(fn, fnmapping)
+
+def estimate_matches(lit, bound, data, fnmapping):
+    rels = literal_relations(lit, fnmapping)
+    positions = tuple(n for n, arg in enumerate(lit.args) if arg is not Ellipsis and (
+        not isinstance(arg, Variable) or arg.varname in bound))
+    size = sum(data.count(rel) for rel in rels)
+    if not positions or not size:
+        return size
+    distinct = sum(data.distinct(rel, positions) or 0 for rel in rels)
+    if distinct:
+        return size / distinct
+    return size * SELECTIVITY ** len(positions)
+
+def delta_sources(rule, delta, recursive, fnmapping):
+    # one source list per positive literal over a recursive relation, reading that literal from delta
+    if rule.body is None:
+        return
+    literals = rule.body.as_list()
+    for n, lit in enumerate(literals):
+        if not isinstance(lit, (Formula, CallFormula)) or fnmapping.get(lit.fn, lit.fn) not in recursive:
+            continue
+        if not any(delta.count(rel) for rel in literal_relations(lit, fnmapping)):
+            continue
+        sources = [None] * len(literals)
+        sources[n] = delta
+        yield sources
+
 def step(rules_always, rules_stratified, rules_next, init, fnmapping):
     changed = False
 
@@ -658,5 +2633,8 @@ def oracle(fn):
     return Oracle(fn)
 
 
-def call(fn):
+def call(fn, memoize=False, ttl_cycles=None, ttl_seconds=None, maxsize=None):
+    # memoized calls are only invoked for arguments without a live cached result
+    if memoize or ttl_cycles is not None or ttl_seconds is not None or maxsize is not None:
+        return Call(fn, CallMemo(ttl_cycles, ttl_seconds, maxsize))
     return Call(fn)
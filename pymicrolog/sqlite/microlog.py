@@ -1,7 +1,10 @@
+from collections import namedtuple
 from enum import Enum
 from itertools import zip_longest
 import sqlite3
 
+StateDelta = namedtuple("StateDelta", ["added", "removed", "state"])
+
 class TemporalAnnotation(Enum):
     START = 1
     NEXT = 2
@@ -502,21 +505,23 @@ class Program():
                 raise ValueError("Unsupported rule head", rule.head)
         assert numberOfRules == len(self.initial) + len(self.next) + len(
             self.always) + len(unstratified)
-        # Create dependency graph
-        deps = set()
+        # Create dependency graph, every relation maps to the relations it reads, -1 if negated
+        deps = {}
 
         def make_edge(head, body):
-            if isinstance(head, Formula):
-                deps.add((head.fn, 0, head.fn))
+            edges = deps.setdefault(head.fn, {})
             if isinstance(body, Formula):
-                deps.add((head.fn, 0, body.fn))
+                edges.setdefault(body.fn, 0)
+                deps.setdefault(body.fn, {})
             elif isinstance(body, NegatedFormula):
-                deps.add((head.fn, -1, body.orig.fn))
+                edges[body.orig.fn] = -1
+                deps.setdefault(body.orig.fn, {})
             else:
                 pass
 
         for rule in unstratified:
             assert rule.body is not None
+            deps.setdefault(rule.head.fn, {})
             if isinstance(rule.body, (Formula, NegatedFormula)):
                 make_edge(rule.head, rule.body)
             elif isinstance(rule.body, Conjunction):
@@ -527,46 +532,14 @@ class Program():
             else:
                 raise ValueError("Unsupported Rule configuration", rule)
 
-        # calculate reachability
-        import itertools
-        rels = set(f for f, val, t in deps) | set(t for f, val, t in deps)
-        edeps = set()
-        for r in rels:
-          reachable = {r: 0}
-          while True:
-            traversal = (len(reachable), sum(reachable.values()))
-            for df, v, dt in deps:
-              if df in reachable:
-                reachable[dt] = min(v, reachable.get(dt, 0), reachable.get(df, 0))
-            if traversal == (len(reachable), sum(reachable.values())):
-              break
-          for reach in reachable:
-            edeps.add((r, reachable[reach] ,reach))
-        deps = edeps
-
-        # calculate a stratification
-        strata = []
-        while deps:  # Algorithm according to Ceri/Gottlob/Tanca 1990
-            this_stratum = set(f for f, val, t in deps)
-            for f, val, t in deps:
-                if val == -1:
-                    this_stratum.discard(f)
-            strata.append(this_stratum)
-            old_deps, deps = deps, set()
-            while old_deps:
-                f, val, t = old_deps.pop()
-                if f in this_stratum or t in this_stratum:
-                    continue
-                deps.add((f, val, t))
+        # calculate a stratification, a relation goes into the stratum given by the most negations
+        # on a dependency path starting at it, as the Ceri/Gottlob/Tanca 1990 algorithm would place it
+        levels = stratum_levels(deps)
 
         # select rules into strata
-        self.strata = []
-        for stratum in strata:
-            this_stratum = []
-            for rule in unstratified:
-                if rule.head.fn in stratum:
-                    this_stratum.append(rule)
-            self.strata.append(this_stratum)
+        self.strata = [[] for _ in range(max(levels.values()) + 1)] if levels else []
+        for rule in unstratified:
+            self.strata[levels[rule.head.fn]].append(rule)
         assert sum(len(s) for s in self.strata) == len(
             unstratified)  # we did not forget a rule
 
@@ -574,11 +547,14 @@ class Program():
         for iofacts in self.run_generator(cycles, fnmapping):
             pass
 
-    def run_cb(self, cycles=None, cb=None, fnmapping=None, extended_state=False):
-        for iofacts in self.run_generator(cycles, fnmapping, extended_state):
+    def run_cb(self, cycles=None, cb=None, fnmapping=None, extended_state=False, delta=False):
+        for iofacts in self.run_generator(cycles, fnmapping, extended_state, delta):
             cb(iofacts)
 
-    def run_generator(self, cycles=None, fnmapping=None, extended_state=False):
+    def run_generator(self, cycles=None, fnmapping=None, extended_state=False, delta=False):
+        # delta: yield a StateDelta of the facts added and removed since the previous cycle's output
+        # and a read only view of the output instead of a copy of it; finding them compares the
+        # whole output with the previous one
         fnmapping = {} if fnmapping is None else fnmapping
         fnmapping = {**self.fnmapping, **fnmapping}
 
@@ -613,6 +589,7 @@ class Program():
         for initial_fact in initial_facts:
             model_db_cursor.execute(fact_to_sql_insert(initial_fact))
         model = initial_facts
+        output = frozenset()
         while True:
             if cycles == 0:
                 break
@@ -646,13 +623,35 @@ class Program():
                     iofacts.add(iofact)
             model_db_cursor.execute("DELETE FROM model WHERE state = 0")
             model_db_cursor.execute("UPDATE model SET state = 0")
-            if extended_state:
+            if delta:
+                previous, output = output, next_model | iofacts if extended_state else iofacts
+                yield StateDelta(frozenset(output - previous), frozenset(previous - output), StateView(output))
+            elif extended_state:
                 yield frozenset(next_model | iofacts)
             else:
                 yield frozenset(iofacts)
             if cycles is not None:
                 cycles = cycles - 1
 
+class StateView():
+    # read only access to the facts output by a cycle
+    facts = None
+
+    def __init__(self, facts):
+        self.facts = facts
+
+    def __contains__(self, fact):
+        return fact in self.facts
+
+    def __iter__(self):
+        return iter(self.facts)
+
+    def __len__(self):
+        return len(self.facts)
+
+    def __repr__(self):
+        return "StateView({})".format(repr(self.facts))
+
 def columns(n, leading=", "):
     s = ", ".join(("c" + str(c)) for c in range(n))
     if s:
@@ -667,6 +666,58 @@ def fact_to_sql_insert(fact, state=0):
         raise NotImplementedError(fact)
     return "INSERT INTO model (state, relation" + columns(len(fact[1])) + ") VALUES (" + str(state) + ', ' + rel_str + arg_str + ") ON CONFLICT DO NOTHING"
 
+def stratum_levels(deps):
+    # the stratum of every relation in deps, computed over its strongly connected components with
+    # Tarjan's algorithm: components are completed after everything they read
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    levels = {}
+    for root in deps:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(deps[root]))]
+        while work:
+            rel, edges = work[-1]
+            for dep in edges:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, iter(deps[dep])))
+                    break
+                if dep in on_stack:
+                    lowlink[rel] = min(lowlink[rel], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[rel])
+                if lowlink[rel] != index[rel]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == rel:
+                        break
+                level = 0
+                for member in component:
+                    for dep, sign in deps[member].items():
+                        if dep not in levels:  # inside the component, the others are done
+                            if sign:
+                                raise ValueError("Program not stratifiable, negation in a recursive cycle", member, dep)
+                        else:
+                            level = max(level, levels[dep] - sign)
+                for member in component:
+                    levels[member] = level
+    return levels
+
 def formula_to_fact(formula, fnmapping=None):
     fnmapping = {} if fnmapping is None else fnmapping
     fn = fnmapping[formula.fn] if formula.fn in fnmapping else formula.fn
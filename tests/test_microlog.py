@@ -0,0 +1,270 @@
+import concurrent.futures
+import operator
+import time
+
+import pytest
+
+from pymicrolog.microlog import START, NEXT, relation, variables, oracle, call, Program
+from pymicrolog.microlog import Model
+
+
+def test_concurrent_strata_wait_for_every_writer():
+    # r has an always rule and derived rules in different strata, t reads it in a later one
+    q, r, t, out = relation("q"), relation("r"), relation("t"), relation("out")
+    X, = variables("X")
+    slow = oracle(lambda: time.sleep(0.05) or True)
+    rules = [
+        q(2)@START,
+        q(X)@NEXT <= q(X),
+        r(1) <= slow(),
+        r(X) <= q(X),
+        t(X) <= r(X) & ~q(X),
+        out(X)@NEXT <= t(X),
+    ]
+    expected = list(Program(rules).run_generator(cycles=3, extended_state=True))
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        states = list(Program(rules).run_generator(cycles=3, extended_state=True, strata_executor=executor))
+    assert (out, (1,)) in expected[1]
+    assert states == expected
+
+
+def test_fnmapping_aliases_are_not_static():
+    # a is read through b, whose facts change every cycle
+    a, b, c, t = relation("a"), relation("b"), relation("c"), relation("t")
+    X, = variables("X")
+    rules = [
+        a(0),
+        b(1)@START,
+        b(2)@NEXT <= b(1),
+        b(3)@NEXT <= b(2),
+        c(X) <= a(X),
+        t(X)@NEXT <= c(X),
+    ]
+    for program, run_fnmapping in ((Program(rules, fnmapping={a: b}), None), (Program(rules), {a: b})):
+        states = list(program.run_generator(cycles=3, fnmapping=run_fnmapping, extended_state=True))
+        assert [sorted(args for rel, args in state if rel is t) for state in states] == [[(0,), (1,)], [(0,), (2,)], [(0,), (3,)]]
+
+
+def test_numeric_table_follows_added_and_removed_facts():
+    pytest.importorskip("numpy")
+    r = relation("r")
+    model = Model([(r, (n, n + 1)) for n in range(10)])
+    assert sorted(model.numeric_table((r,), 2).tolist()) == [[n, n + 1] for n in range(10)]
+    model.discard((r, (0, 1)))
+    model.add((r, (20, 21)))
+    assert sorted(model.numeric_table((r,), 2).tolist()) == [[n, n + 1] for n in range(1, 10)] + [[20, 21]]
+    model.add((r, ("a", 1)))
+    assert model.numeric_table((r,), 2) is None
+    model.discard((r, ("a", 1)))
+    assert len(model.numeric_table((r,), 2)) == 10
+
+
+def test_numpy_backend_matches_python():
+    pytest.importorskip("numpy")
+    e, path, out = relation("e"), relation("path"), relation("out")
+    X, Y, Z = variables("X", "Y", "Z")
+    rules = [e(n, (n * 7 + 3) % 300)@START for n in range(300)]
+    rules += [
+        e(X, Y)@NEXT <= e(X, Y),
+        path(X, Y) <= e(X, Y),
+        path(X, Z) <= path(X, Y) & e(Y, Z) & (X < Z),
+        out(X)@NEXT <= path(X, X),
+    ]
+    expected = list(Program(rules).run_generator(cycles=3, extended_state=True))
+    for kw in ({}, {"incremental": True}):
+        assert list(Program(rules, backend="numpy", **kw).run_generator(cycles=3, extended_state=True)) == expected
+
+
+def test_plans_are_kept_until_relation_sizes_drift(monkeypatch):
+    # path grows by one fact per semi-naive round, so a cycle takes 20 rounds but only
+    # a few replans, and rules with a single relation literal are never planned
+    e, path = relation("e"), relation("path")
+    X, Y, Z = variables("X", "Y", "Z")
+    rules = [e(n, n + 1)@START for n in range(20)]
+    rules += [e(X, Y)@NEXT <= e(X, Y), path(X, Y) <= e(X, Y), path(X, Z) <= path(X, Y) & e(Y, Z)]
+    program = Program(rules)
+    planned = []
+    join_order = program.join_order
+    monkeypatch.setattr(program, "join_order", lambda *args: planned.append(args[0]) or join_order(*args))
+    program.run(1)
+    assert 0 < len(planned) <= 8
+    assert all(len(rule.body.as_list()) == 2 for rule in planned)
+
+
+def test_delta_output_rebuilds_the_states():
+    c, n = relation("c"), relation("n")
+    X, = variables("X")
+    rules = [c(0)@START, c(1)@NEXT <= c(0), c(2)@NEXT <= c(1), c(0)@NEXT <= c(2)]
+    rules += [n(i)@START for i in range(4)] + [n(X)@NEXT <= n(X) & ~c(X)]
+    for kw in ({}, {"incremental": True}):
+        expected = list(Program(rules, **kw).run_generator(cycles=6, extended_state=True))
+        state = set()
+        for (added, removed, view), full in zip(Program(rules, **kw).run_generator(cycles=6, extended_state=True, delta=True), expected):
+            state = (state | added) - removed
+            assert state == full == set(view)
+
+
+def test_incremental_runs_match_full_runs():
+    # edges of a ring are dropped and restored as the clock turns, so maintenance has to
+    # retract paths and facts derived through negation as well as add them back
+    clock, e, path, cut, reach, lone, out = (relation(name) for name in ("clock", "e", "path", "cut", "reach", "lone", "out"))
+    X, Y, Z = variables("X", "Y", "Z")
+    rules = [clock(0)@START] + [clock((n + 1) % 5)@NEXT <= clock(n) for n in range(5)]
+    rules += [e(n, (n + 1) % 5) for n in range(5)]
+    rules += [
+        cut(X, Y) <= clock(X) & e(X, Y),
+        path(X, Y) <= e(X, Y) & ~cut(X, Y),
+        path(X, Z) <= path(X, Y) & path(Y, Z),
+        reach(X) <= path(0, X),
+        lone(X) <= e(X, Y) & ~reach(X),
+        out(X)@NEXT <= reach(X),
+        out(X)@NEXT <= lone(X) & ~clock(X),
+    ]
+    expected = list(Program(rules).run_generator(cycles=12, extended_state=True))
+    assert len(set(expected[1:6])) == 5
+    assert list(Program(rules, incremental=True).run_generator(cycles=12, extended_state=True)) == expected
+    assert list(Program(rules, incremental=True).run_generator(cycles=12)) == list(Program(rules).run_generator(cycles=12))
+
+
+def test_concurrent_strata_with_aliased_relations():
+    # x is read in the first stratum and aliased to y, which a later stratum writes as well
+    s, x, y, z, w, out = (relation(name) for name in ("s", "x", "y", "z", "w", "out"))
+    X, = variables("X")
+    rules = [
+        s(1)@START,
+        s(7)@START,
+        s(X)@NEXT <= s(X),
+        x(X) <= s(X),
+        z(X) <= x(X),
+        w(X) <= s(X) & (X > 5),
+        y(X) <= s(X) & ~w(X),
+        out(X)@NEXT <= z(X),
+        out(X)@NEXT <= y(X),
+    ]
+    aliases = {x: y}
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        for program_aliases, run_aliases in ((aliases, None), ({}, aliases)):
+            expected = list(Program(rules, fnmapping=program_aliases).run_generator(cycles=3, extended_state=True, fnmapping=run_aliases))
+            states = list(Program(rules, fnmapping=program_aliases).run_generator(cycles=3, extended_state=True, fnmapping=run_aliases, strata_executor=executor))
+            assert states == expected
+
+
+def test_magic_sets_match_the_plain_program():
+    # path is only read from the node in q; extra is aliased to path by the run's fnmapping
+    e, path, extra, q, out = (relation(name) for name in ("e", "path", "extra", "q", "out"))
+    X, Y, Z = variables("X", "Y", "Z")
+    rules = [e(n, (n * 3 + 1) % 20)@START for n in range(20)] + [e(n, 0) for n in range(15, 18)]
+    rules += [
+        q(1)@START,
+        q(X)@NEXT <= q(X),
+        e(X, Y)@NEXT <= e(X, Y) & (X > 0),
+        extra(X, 99) <= q(X),
+        path(X, Y) <= e(X, Y),
+        path(X, Z) <= path(X, Y) & e(Y, Z),
+        out(Y)@NEXT <= q(X) & path(X, Y),
+    ]
+    for program_aliases, run_aliases in (({}, None), ({extra: path}, None), ({}, {extra: path})):
+        expected = list(Program(rules, fnmapping=program_aliases).run_generator(cycles=4, extended_state=True, fnmapping=run_aliases))
+        states = list(Program(rules, fnmapping=program_aliases, magic_sets=True).run_generator(cycles=4, extended_state=True, fnmapping=run_aliases))
+        assert states == expected
+
+
+def test_memoized_calls_are_cached_per_resolved_function():
+    config, seen = call("config", memoize=True), relation("seen")
+    X, = variables("X")
+    rules = [config()@NEXT, seen(X)@NEXT <= config(X)]
+    first = list(Program(rules).run_generator(cycles=3, fnmapping={"config": lambda: 1}, extended_state=True))
+    second = list(Program(rules).run_generator(cycles=3, fnmapping={"config": lambda: 2}, extended_state=True))
+    assert (seen, (1,)) in first[-1]
+    assert (seen, (2,)) in second[-1] and (seen, (1,)) not in second[-1]
+
+
+def test_run_periodic_keeps_the_schedule():
+    c = relation("c")
+    rules = [c(0)@START] + [c(n + 1)@NEXT <= c(n) for n in range(5)]
+    states = []
+    started = time.monotonic()
+    stats = Program(rules).run_periodic(0.02, cycles=5, cb=states.append, extended_state=True)
+    assert time.monotonic() - started >= 4 * 0.02
+    assert states == [frozenset({(c, (n,))}) for n in range(1, 6)]
+    report = stats.report()
+    assert report["cycles"] == 5 and report["skipped_periods"] == 0
+    assert sum(count for bound, count in report["latency_histogram"]) == 5
+
+
+def test_run_periodic_overruns():
+    c = relation("c")
+    slow = oracle(lambda: time.sleep(0.03) or True)
+    rules = [c(0)@START, c(0)@NEXT <= c(0) & slow()]
+    with pytest.warns(RuntimeWarning):
+        stats = Program(rules).run_periodic(0.01, cycles=3)
+    assert stats.deadline_misses == 3
+    stats = Program(rules).run_periodic(0.01, cycles=3, overrun="skip")
+    assert stats.deadline_misses == 3 and stats.skipped >= 3
+    assert stats.report()["latency_histogram"][-1] == (float("inf"), 3)
+    with pytest.raises(ValueError):
+        Program(rules).run_periodic(0.01, cycles=3, overrun="never")
+
+
+def test_injected_facts_arrive_in_the_next_cycle():
+    cmd, seen, config = relation("cmd"), relation("seen"), relation("config")
+    X, = variables("X")
+    program = Program([config(1), seen(X)@NEXT <= cmd(X), seen(X)@NEXT <= seen(X)])
+    run = program.run_generator(cycles=4, extended_state=True)
+    assert next(run) == frozenset()
+    program.inject(cmd("a"), cmd("b"))
+    assert next(run) == {(cmd, ("a",)), (cmd, ("b",))}
+    assert next(run) == {(seen, ("a",)), (seen, ("b",))}
+    program.inject(cmd("c"))
+    assert next(run) == {(seen, ("a",)), (seen, ("b",)), (cmd, ("c",))}
+    with pytest.raises(ValueError):
+        program.inject(cmd(X))
+    with pytest.raises(ValueError):
+        program.inject(config(2))
+
+
+def test_saved_programs_load_and_run_the_same(tmp_path):
+    e, path, out = relation("e"), relation("path"), relation("out")
+    X, Y, Z = variables("X", "Y", "Z")
+    small = oracle(operator.lt)
+    log = call("log")
+    rules = [e(n, n + 1)@START for n in range(5)]
+    rules += [
+        e(X, Y)@NEXT <= e(X, Y),
+        path(X, Y) <= e(X, Y),
+        path(X, Z) <= path(X, Y) & e(Y, Z),
+        out(X, Y)@NEXT <= path(X, Y) & small(Y, 3),
+        log(X)@NEXT <= out(X, 2),
+    ]
+    program = Program(rules)
+    expected = list(program.run_generator(cycles=3, fnmapping={"log": str}, extended_state=True))
+    program.save(tmp_path / "program.pkl")
+    loaded = Program.load(tmp_path / "program.pkl", relations=[e, path, out])
+    assert list(loaded.run_generator(cycles=3, fnmapping={"log": str}, extended_state=True)) == expected
+    with pytest.raises(ValueError):
+        Program(rules + [out(X, X)@NEXT <= e(X, Y) & oracle(lambda x: x > 3)(X)]).save(tmp_path / "lambda.pkl")
+
+
+def test_memoized_calls_expire_and_evict():
+    invoked = []
+
+    def read(key):
+        invoked.append(key)
+        return key.upper()
+
+    fetch, lru = call("fetch", ttl_cycles=2), call("lru", maxsize=2)
+    rules = [fetch("a")@NEXT]
+    Program(rules).run(5, fnmapping={"fetch": read})
+    # cached for the cycle after each invocation
+    assert invoked == ["a", "a", "a"]
+    assert fetch.cache_info() == (2, 3, None, 1)
+
+    invoked.clear()
+    turn = relation("turn")
+    keys = ("a", "b", "a", "c", "a", "b")
+    rules = [turn(0)@START] + [turn(n + 1)@NEXT <= turn(n) for n in range(len(keys) - 1)]
+    rules += [lru(key)@NEXT <= turn(n) for n, key in enumerate(keys)]
+    Program(rules).run(len(keys), fnmapping={"lru": read})
+    # c evicts b, the least recently used key, and b evicts c
+    assert invoked == ["a", "b", "c", "b"]
+    assert lru.cache_info() == (2, 4, 2, 2)